@@ -0,0 +1,581 @@
+#!/usr/bin/python
+
+# Copyright (c) 2011 Evan Broder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import imp
+import itertools
+import optparse
+import os
+import random
+import resource
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+OSD = os.path.join(HERE, 'irccloud-osd.py')
+REPLAY = os.path.join(HERE, 'irccloud-replay.py')
+
+osd = imp.load_source('irccloud_osd', OSD)
+
+
+MB = 1024 * 1024
+
+LINE = ('{"bid":%d, "eid":%d, "type":"buffer_msg", "time":1300000000, '
+        '"highlight":false, "from":"somebody", "msg":"%s", "cid":1709}\n')
+
+
+def synthetic_stream(size):
+    lines = []
+    total = 0
+    eid = 0
+    while total < size:
+        eid += 1
+        line = LINE % (11162 + eid % 50, eid, 'x' * (eid % 200))
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines)
+
+
+def chunks(data, chunk_size):
+    for i in xrange(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+
+def timed(fn):
+    start = time.time()
+    fn()
+    return time.time() - start
+
+
+def bench_framer(opts):
+    print 'Line framing (%d byte chunks)' % opts.chunk_size
+    print '%-12s %10s %10s %12s' % ('shape', 'MB', 'seconds', 'MB/s')
+
+    for shape in ('lines', 'one-line'):
+        for mb in opts.sizes:
+            if shape == 'lines':
+                data = synthetic_stream(mb * MB)
+            else:
+                data = 'x' * (mb * MB) + '\n'
+            pieces = list(chunks(data, opts.chunk_size))
+
+            framer = osd.LineFramer(lambda line: None)
+            def run():
+                for piece in pieces:
+                    framer.feed(piece)
+            elapsed = timed(run)
+
+            print '%-12s %10d %10.3f %12.1f' % (shape, mb, elapsed,
+                                               mb / elapsed)
+
+
+def synthetic_backlog(size, buffers=50):
+    head = []
+    head.append('{"bid":-1, "eid":-1, "type":"makeserver", "time":-1, '
+                '"highlight":false, "cid":1709, "name":"IRCCloud"}\n')
+    for i in xrange(buffers):
+        head.append('{"bid":%d, "eid":-1, "type":"makebuffer", "time":-1, '
+                    '"highlight":false, "name":"#chan%d", '
+                    '"buffer_type":"channel", "cid":1709, "hidden":false}\n' %
+                    (11162 + i, i))
+    return ''.join(head) + synthetic_stream(size)
+
+
+def bench_dispatch(opts):
+    print 'Backlog dispatch (before backlog_complete)'
+    print '%-12s %10s %10s %12s' % ('MB', 'lines', 'seconds', 'lines/s')
+
+    for mb in opts.sizes:
+        lines = synthetic_backlog(mb * MB).split('\n')
+
+        sh = osd.StreamHandler(osd.Notifier(osd.PollLoop(), []))
+        def run():
+            for line in lines:
+                sh.on_line(line)
+        elapsed = timed(run)
+
+        print '%-12d %10d %10.3f %12.0f' % (mb, len(lines), elapsed,
+                                            len(lines) / elapsed)
+
+
+MAKEBUFFER = ('{"bid":%d, "eid":-1, "type":"makebuffer", "time":-1, '
+              '"highlight":false, "name":"#channel%d", '
+              '"buffer_type":"channel", "cid":1709, "max_eid":83, '
+              '"focus":true, "last_seen_eid":41, "joined":false, '
+              '"hidden":false}')
+
+
+def deep_size(obj, seen=None):
+    """Roughly how many bytes obj and everything it references take.
+
+    Objects are only counted once, so strings shared between
+    instances (like interned keys) aren't counted over and over.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deep_size(k, seen) + deep_size(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += deep_size(v, seen)
+    elif hasattr(obj, '__slots__'):
+        for k in obj.__slots__:
+            size += deep_size(getattr(obj, k, None), seen)
+    return size
+
+
+def bench_memory(opts):
+    print 'Buffer state memory'
+    print '%-12s %10s %14s' % ('storage', 'buffers', 'bytes/buffer')
+
+    events = [osd.simplejson.loads(MAKEBUFFER % (i, i))
+              for i in xrange(opts.buffers)]
+    for name, build in (('event dict', lambda ev: ev),
+                        ('Buffer', lambda ev: osd.Buffer(**ev))):
+        buffers = dict((ev['bid'], build(ev)) for ev in events)
+        print '%-12s %10d %14.0f' % (name, len(buffers),
+                                     float(deep_size(buffers)) / len(buffers))
+
+
+def bench_archive(opts):
+    print 'Archive writes and queries'
+    print '%-6s %10s %10s %10s %10s %10s %10s' % (
+        'MB', 'lines/s', 'disk MB', 'tail ms', 'hilite ms', 'restore ms',
+        'hilites')
+
+    for mb in opts.sizes:
+        lines = synthetic_backlog(mb * MB).split('\n')
+        # Make one message in a thousand a highlight
+        for i in xrange(len(lines) - 1, 0, -1000):
+            lines[i] = lines[i].replace('"highlight":false',
+                                        '"highlight":true')
+        kinds = [osd.TYPE_RE.search(line) for line in lines]
+        kinds = [m and m.group(1) for m in kinds]
+
+        path = tempfile.mkdtemp()
+        try:
+            archive = osd.Archive(path)
+            def run():
+                for line, kind in itertools.izip(lines, kinds):
+                    archive.append(line, kind)
+                archive.flush()
+            elapsed = timed(run)
+            disk = sum(os.path.getsize(os.path.join(path, name))
+                       for name in os.listdir(path))
+
+            # Queries run against a fresh, cold instance
+            archive = osd.Archive(path)
+            tail = timed(lambda: archive.tail(11162, 100))
+            found = []
+            highlights = timed(lambda: found.extend(archive.highlights(0)))
+            sh = osd.StreamHandler(osd.Notifier(osd.PollLoop(), []))
+            restore = timed(lambda: archive.restore(sh))
+        finally:
+            shutil.rmtree(path)
+
+        print '%-6d %10.0f %10.2f %10.2f %10.2f %10.2f %10d' % (
+            mb, len(lines) / elapsed, float(disk) / MB, tail * 1000,
+            highlights * 1000, restore * 1000, len(found))
+
+
+def bench_rules(opts):
+    print 'Rule matching'
+    print '%-12s %10s %10s %12s' % ('keywords', 'messages', 'seconds', 'msgs/s')
+
+    rng = random.Random(0)
+    def word():
+        return ''.join(rng.choice(string.ascii_lowercase)
+                       for _ in xrange(rng.randint(4, 10)))
+    messages = [{'msg': ' '.join(word() for _ in xrange(12)),
+                 'from': word()}
+                for _ in xrange(opts.messages)]
+    server = osd.Server(cid=1709, name='IRCCloud')
+    buf = osd.Buffer(bid=11162, cid=1709, name='#chan', buffer_type='channel')
+
+    for count in opts.keywords:
+        engine = osd.RuleEngine({
+            'keywords': [word() for _ in xrange(count)],
+            'regexes': [r'\bdeploy(ed|ing)?\b', r'build (failed|broke)'],
+            'nicks': ['ops-*', 'alert?bot'],
+            'scopes': {'IRCCloud/#chan': {'keywords': [word()
+                                                       for _ in xrange(count)]}},
+            })
+        def run():
+            for ev in messages:
+                engine.check(server, buf, ev, False)
+        elapsed = timed(run)
+
+        print '%-12d %10d %10.3f %12.0f' % (count, len(messages), elapsed,
+                                            len(messages) / elapsed)
+
+
+class LatencySink(object):
+    """Work out how long live replay messages took to reach a sink."""
+
+    def __init__(self):
+        self.latencies = []
+
+    def emit(self, batch):
+        now = time.time()
+        for line in batch['lines']:
+            if '@' in line:
+                self.latencies.append(now - float(line.rsplit('@', 1)[1]))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def start_replay(args):
+    """Run irccloud-replay.py and return (process, base URL)."""
+    server = subprocess.Popen([sys.executable, REPLAY] + args,
+                              stdout=subprocess.PIPE)
+    port = int(server.stdout.readline())
+    return server, 'http://127.0.0.1:%d' % port
+
+
+def replay_stats(base_url):
+    return osd.simplejson.load(urllib2.urlopen(base_url + '/stats'))
+
+
+def run_client(base_url, extra_args=()):
+    """Log in to base_url and follow its stream until the server hangs up.
+
+    Returns (seconds until backlog_complete, lines in the backlog,
+    latencies of live messages).
+    """
+    client_opts = osd.parse_options(['-e', 'bench@example.com',
+                                     '-p', 'bench',
+                                     '--base-url', base_url,
+                                     '--state-dir', '',
+                                     '--coalesce', '0',
+                                     # Bursts mustn't push lines out
+                                     '--history', '1000',
+                                     '--rate-limit', '1000000'] +
+                                    list(extra_args))
+
+    loop = osd.PollLoop()
+    cm = osd.CurlManager(loop)
+    sink = LatencySink()
+    worker = osd.SinkWorker(sink, 'bench', max_lines=1000)
+    worker.start()
+    notifier = osd.Notifier(loop, [worker], client_opts.coalesce,
+                            client_opts.history, client_opts.rate_limit)
+
+    account = osd.Account(client_opts.email, client_opts.password, cm,
+                          notifier, None, client_opts,
+                          lambda account: loop.stop())
+    # Don't reconnect once the replay is over
+    def stream_done(c, err, errmsg):
+        # Let anything the drain turns up reach the sink first
+        account.sh.drain()
+        loop.call_later(0, loop.stop)
+    account.stream_done = stream_done
+
+    result = {}
+    start = time.time()
+
+    def watch_backlog():
+        if account.sh.past_backlog:
+            result['backlog'] = time.time() - start
+            result['lines'] = sum(account.sh.line_counts.itervalues())
+        else:
+            loop.call_later(0.001, watch_backlog)
+    loop.call_later(0.001, watch_backlog)
+
+    account.start()
+    loop.run()
+    worker.stop()
+
+    return result.get('backlog'), result.get('lines'), sink.latencies
+
+
+def run_client_process(base_url, extra_args=()):
+    """Run run_client in a fresh interpreter, so its peak RSS is its own.
+
+    Returns run_client's results plus the client's peak RSS in KB.
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--client', base_url]
+    for arg in extra_args:
+        cmd += ['--client-arg', arg]
+    client = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    out, _ = client.communicate()
+    if client.returncode:
+        raise RuntimeError('Benchmark client exited with %d' %
+                           client.returncode)
+    return osd.simplejson.loads(out)
+
+
+def bench_stream(opts):
+    for i, burst in enumerate(opts.bursts):
+        if i:
+            print
+        print 'End-to-end stream from irccloud-replay.py, bursts of %d' % burst
+
+        server, base_url = start_replay([
+                '--chunk-size', str(opts.chunk_size),
+                '--servers', str(opts.servers),
+                '--buffers', str(opts.buffers // opts.servers),
+                '--backlog', str(opts.backlog),
+                '--live', str(opts.live),
+                '--burst', str(burst)])
+        results = []
+        try:
+            for workers in opts.backlog_workers:
+                results.append(run_client_process(
+                        base_url, ['--backlog-workers', str(workers)]))
+        finally:
+            server.terminate()
+            server.wait()
+
+        def row(label, fmt, values):
+            print '%-28s' % label + ''.join(fmt % v for v in values)
+
+        row('backlog workers', '%12d', opts.backlog_workers)
+        row('seconds to backlog_complete', '%12.3f',
+            [backlog for backlog, _, _, _ in results])
+        row('backlog events/s', '%12.0f',
+            [lines / backlog for backlog, lines, _, _ in results])
+        row('live notifications', '%12d',
+            [len(latencies) for _, _, latencies, _ in results])
+        row('p50 notify latency (ms)', '%12.2f',
+            [percentile(latencies, 0.5) * 1000
+             for _, _, latencies, _ in results])
+        row('p99 notify latency (ms)', '%12.2f',
+            [percentile(latencies, 0.99) * 1000
+             for _, _, latencies, _ in results])
+        row('client peak RSS (KB)', '%12d', [rss for _, _, _, rss in results])
+
+
+def bench_startup(opts):
+    print 'Startup against irccloud-replay.py'
+
+    server, base_url = start_replay([
+            '--chunk-size', str(opts.chunk_size),
+            '--servers', str(opts.servers),
+            '--buffers', str(opts.buffers // opts.servers),
+            '--backlog', str(opts.backlog),
+            '--live', '0'])
+    state_dir = tempfile.mkdtemp()
+    # The second run logs in and caches its session for the third
+    runs = [('plain', ['--no-compression']),
+            ('gzip', ['--state-dir', state_dir]),
+            ('gzip, cached session', ['--state-dir', state_dir])]
+    results = []
+    try:
+        for label, args in runs:
+            before = replay_stats(base_url)
+            backlog, lines, _ = run_client(base_url, args)
+            after = replay_stats(base_url)
+            # Leave out the /stats request itself
+            after['connections'] -= 1
+            results.append((label, backlog, dict(
+                        (k, after[k] - before[k]) for k in after)))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(state_dir)
+
+    print '%-24s %12s %8s %12s %12s' % ('', 'seconds', 'logins',
+                                         'connections', 'wire KB')
+    for label, backlog, stats in results:
+        print '%-24s %12.3f %8d %12d %12.0f' % (
+            label, backlog, stats['logins'], stats['connections'],
+            stats['wire_bytes'] / 1024.0)
+
+
+def bench_coldstart(opts):
+    print 'Cold start to first notification, %d runs' % opts.runs
+
+    server, base_url = start_replay([
+            '--servers', str(opts.servers),
+            '--buffers', str(opts.buffers // opts.servers),
+            '--backlog', '1000',
+            '--live', '1',
+            '--live-rate', '1000'])
+    times = []
+    devnull = open(os.devnull, 'w')
+    try:
+        for _ in xrange(opts.runs):
+            start = time.time()
+            client = subprocess.Popen([sys.executable, OSD,
+                                       '-e', 'bench@example.com',
+                                       '-p', 'bench',
+                                       '--base-url', base_url,
+                                       '--loop', 'poll',
+                                       '--sink', 'json',
+                                       '--state-dir', '',
+                                       '--coalesce', '0'],
+                                      stdout=subprocess.PIPE,
+                                      stderr=devnull)
+            client.stdout.readline()
+            times.append(time.time() - start)
+            client.terminate()
+            client.wait()
+    finally:
+        devnull.close()
+        server.terminate()
+        server.wait()
+
+    print '%-28s %12.1f' % ('fastest (ms)', min(times) * 1000)
+    print '%-28s %12.1f' % ('median (ms)', percentile(times, 0.5) * 1000)
+    print '%-28s %12.1f' % ('slowest (ms)', max(times) * 1000)
+
+
+SUITES = [
+    ('framer', bench_framer),
+    ('dispatch', bench_dispatch),
+    ('memory', bench_memory),
+    ('rules', bench_rules),
+    ('archive', bench_archive),
+    ('stream', bench_stream),
+    ('startup', bench_startup),
+    ('coldstart', bench_coldstart),
+    ]
+
+
+def parse_options():
+    p = optparse.OptionParser(
+        usage='%%prog [options] [%s ...]' % ' '.join(n for n, _ in SUITES))
+    p.add_option('--chunk-size',
+                 dest='chunk_size',
+                 type='int',
+                 default=16384)
+    p.add_option('--size',
+                 dest='sizes',
+                 type='int',
+                 action='append',
+                 help='Stream size in MB (may be repeated)')
+    p.add_option('--buffers',
+                 dest='buffers',
+                 type='int',
+                 default=1000,
+                 help='Number of buffers for the memory and stream '
+                 'benchmarks')
+    p.add_option('--servers',
+                 dest='servers',
+                 type='int',
+                 default=5,
+                 help='Number of servers for the stream benchmark')
+    p.add_option('--backlog',
+                 dest='backlog',
+                 type='int',
+                 default=100000,
+                 help='Backlog messages for the stream benchmark')
+    p.add_option('--live',
+                 dest='live',
+                 type='int',
+                 default=200,
+                 help='Live messages for the stream benchmark')
+    p.add_option('--burst',
+                 dest='bursts',
+                 type='int',
+                 action='append',
+                 help='Live messages the stream benchmark sends back to '
+                 'back (may be repeated)')
+    p.add_option('--client',
+                 dest='client',
+                 help=optparse.SUPPRESS_HELP)
+    p.add_option('--client-arg',
+                 dest='client_args',
+                 action='append',
+                 default=[],
+                 help=optparse.SUPPRESS_HELP)
+    p.add_option('--keywords',
+                 dest='keywords',
+                 type='int',
+                 action='append',
+                 help='Number of keywords per scope for the rule benchmark '
+                 '(may be repeated)')
+    p.add_option('--messages',
+                 dest='messages',
+                 type='int',
+                 default=20000,
+                 help='Number of messages for the rule benchmark')
+
+    p.add_option('--runs',
+                 dest='runs',
+                 type='int',
+                 default=10,
+                 help='Number of cold starts to time')
+    p.add_option('--backlog-workers',
+                 dest='backlog_workers',
+                 type='int',
+                 action='append',
+                 help='Backlog worker processes for the stream benchmark '
+                 '(may be repeated)')
+
+    opts, args = p.parse_args()
+
+    opts.suites = args or [n for n, _ in SUITES]
+    for name in opts.suites:
+        if name not in dict(SUITES):
+            p.error('Unknown benchmark %r' % name)
+
+    if not opts.sizes:
+        opts.sizes = [1, 2, 4, 8, 16]
+    if not opts.keywords:
+        opts.keywords = [10, 100, 1000, 10000]
+    if not opts.bursts:
+        opts.bursts = [1, 20]
+    if not opts.backlog_workers:
+        opts.backlog_workers = [0, 2, 4]
+
+    return opts
+
+
+def main():
+    opts = parse_options()
+
+    # One run of the stream benchmark, in a process of its own
+    if opts.client:
+        result = run_client(opts.client, opts.client_args)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print osd.simplejson.dumps(list(result) + [rss])
+        return
+
+    first = True
+    for name, bench in SUITES:
+        if name not in opts.suites:
+            continue
+        if not first:
+            print
+        first = False
+        bench(opts)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
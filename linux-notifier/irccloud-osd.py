@@ -20,58 +20,900 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import BaseHTTPServer
+import bisect
+import cProfile
+import cStringIO
 import collections
+import errno
+import fnmatch
+import heapq
+import itertools
+import mmap
 import optparse
+import os
+import re
+import select
+import signal
+import socket
+import struct
 import sys
+import tempfile
+import threading
+import time
+import traceback
 import urllib
-import urllib2
+import zlib
 
-import glib
-import gtk
 import pycurl
-import pynotify
 import simplejson
 
+# glib and pynotify take a while to load and plenty of setups don't
+# need them, so GlibLoop and LibnotifySink import them when they're used
+glib = None
+pynotify = None
 
-class IRCCloudNotification(pynotify.Notification):
-    def __init__(self, summary='dummy'):
-        super(IRCCloudNotification, self).__init__(summary)
-        self.set_icon_from_pixbuf(ICON_PIXBUF)
-        self.lines = []
-        self.connect('closed', self.closed)
+CACHE_DIR = os.path.expanduser('~/.cache/irccloud-osd')
 
-    def update(self, summary, line):
-        self.lines.append(line)
-        super(IRCCloudNotification, self).update(summary,
-                                                 '\n'.join(self.lines))
+# How often the main loop looks for signals that have come in
+SIGNAL_INTERVAL = 0.5
+
+
+class Histogram(object):
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """Counters, gauges and latency histograms for the whole pipeline.
+
+    Series are keyed by name and a tuple of (label, value) pairs, and
+    rendered in the Prometheus text format. Counters skip the lock, so
+    they must only be incremented from the event loop's thread. Code
+    on the hottest paths can keep its own counts instead and hand
+    them over through a collector.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self.gauges = {}
+        self.collectors = []
+
+    def inc(self, name, value=1, labels=()):
+        self.counters[(name, labels)] += value
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            h = self.histograms.get((name, labels))
+            if h is None:
+                h = self.histograms[(name, labels)] = Histogram()
+            h.observe(value)
+
+    def add_collector(self, fn):
+        """Add the counters fn() returns to the ones kept here.
+
+        fn should return a list of ((name, labels), value) pairs.
+        """
+        with self.lock:
+            self.collectors.append(fn)
+
+    def gauge(self, name, fn, labels=()):
+        """Report whatever fn() returns at the time metrics are read."""
+        with self.lock:
+            self.gauges[(name, labels)] = fn
+
+    @staticmethod
+    def series(name, labels, extra=()):
+        labels = labels + extra
+        if not labels:
+            return name
+        return '%s{%s}' % (name, ','.join('%s="%s"' % l for l in labels))
+
+    def render(self):
+        out = []
+        with self.lock:
+            out.append('irccloud_uptime_seconds %f' %
+                       (time.time() - self.started))
+            # Copying the dict is atomic, whatever the loop is doing
+            counters = collections.defaultdict(float, self.counters)
+            for fn in self.collectors:
+                for key, value in fn():
+                    counters[key] += value
+            for (name, labels), value in sorted(counters.iteritems()):
+                out.append('%s %f' % (self.series(name, labels), value))
+            for (name, labels), fn in sorted(self.gauges.iteritems()):
+                out.append('%s %f' % (self.series(name, labels), fn()))
+            for (name, labels), h in sorted(self.histograms.iteritems()):
+                total = 0
+                for le, count in zip(Histogram.BUCKETS + ('+Inf',),
+                                     h.counts):
+                    total += count
+                    out.append('%s %d' % (
+                            self.series(name + '_bucket', labels,
+                                        (('le', le),)),
+                            total))
+                out.append('%s %f' % (self.series(name + '_sum', labels),
+                                      h.sum))
+                out.append('%s %d' % (self.series(name + '_count', labels),
+                                      h.count))
+        return '\n'.join(out) + '\n'
+
+
+METRICS = Metrics()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = METRICS.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port):
+    """Serve METRICS on http://localhost:port/metrics from a thread."""
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class Profiler(object):
+    """cProfile the main thread, toggled on and off at runtime."""
+
+    def __init__(self):
+        self.profile = None
+
+    def toggle(self):
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            print >>sys.stderr, 'Profiling started'
+        else:
+            self.profile.disable()
+            fd, path = tempfile.mkstemp(prefix='irccloud-osd.',
+                                        suffix='.prof')
+            os.close(fd)
+            self.profile.dump_stats(path)
+            self.profile = None
+            print >>sys.stderr, 'Profile written to %s' % path
+
+
+def render_icon(xpm, path):
+    """Write an XPM, as a list of strings, to path as a PNG."""
+    width, height, ncolors, cpp = map(int, xpm[0].split())
+    colors = {}
+    for line in xpm[1:1 + ncolors]:
+        spec = line[cpp:].split()
+        colors[line[:cpp]] = spec[spec.index('c') + 1][1:].decode('hex')
+
+    rows = []
+    for line in xpm[1 + ncolors:1 + ncolors + height]:
+        rows.append('\0' + ''.join(colors[line[i:i + cpp]]
+                                   for i in xrange(0, width * cpp, cpp)))
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write('\x89PNG\r\n\x1a\n')
+        f.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height,
+                                          8, 2, 0, 0, 0)))
+        f.write(chunk('IDAT', zlib.compress(''.join(rows), 9)))
+        f.write(chunk('IEND', ''))
+    os.rename(tmp, path)
+
+
+def icon_path(cache_dir=CACHE_DIR):
+    """Return the path of ICON as a PNG, rendering it on first use.
+
+    Returns None if it can't be written.
+    """
+    path = os.path.join(cache_dir, 'icon-%08x.png' %
+                        (zlib.crc32(''.join(ICON)) & 0xffffffff))
+    if not os.path.exists(path):
+        try:
+            try:
+                os.makedirs(cache_dir, 0700)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            render_icon(ICON, path)
+        except (IOError, OSError), e:
+            print >>sys.stderr, "Can't cache the icon: %s" % e
+            return None
+    return path
+
+
+class IRCCloudNotification(object):
+    def __init__(self, history, icon, summary='dummy'):
+        self.icon = icon
+        self.n = pynotify.Notification(summary, None, icon)
+        self.lines = collections.deque(maxlen=history)
+        self.cleared = False
+        self.n.connect('closed', self.closed)
+
+    def update(self, summary, lines):
+        if self.cleared:
+            self.cleared = False
+            self.lines.clear()
+        self.lines.extend(lines)
+        self.n.update(summary, '\n'.join(self.lines), self.icon)
+
+    def show(self):
+        self.n.show()
 
     def closed(self, _):
-        self.lines = []
+        # This runs on the main loop, while update() runs on the sink's
+        # thread, so leave the lines for update() to clear
+        self.cleared = True
+
+
+class LibnotifySink(object):
+    """Show batches as desktop notifications, one per buffer.
+
+    Each notification remembers its last `history` lines, and ones
+    that have been idle for `idle` seconds are forgotten.
+    """
+
+    MAX_NOTIFICATIONS = 64
+
+    def __init__(self, history=10, idle=600):
+        self.history = history
+        self.idle = idle
+        self.icon = None
+        # bid -> (notification, last shown), least recently shown first
+        self.notifications = collections.OrderedDict()
+
+    def open(self):
+        """Load libnotify, from the sink's own thread."""
+        global pynotify
+        import pynotify
+
+        pynotify.init('irccloud-osd')
+        self.icon = icon_path()
+
+    def emit(self, batch):
+        now = time.time()
+
+        n, _ = self.notifications.pop(batch['bid'], (None, None))
+        if n is None:
+            n = IRCCloudNotification(self.history, self.icon)
+        self.notifications[batch['bid']] = (n, now)
+
+        n.update(batch['title'], batch['lines'])
+        n.show()
+
+        self.evict(now)
+
+    def evict(self, now):
+        while self.notifications:
+            bid, (n, shown) = self.notifications.iteritems().next()
+            if (now - shown < self.idle and
+                len(self.notifications) <= self.MAX_NOTIFICATIONS):
+                break
+            del self.notifications[bid]
+
+
+class JSONSink(object):
+    """Write each batch as a line of JSON, to stdout by default."""
+
+    def __init__(self, f=sys.stdout):
+        self.f = f
+
+    def emit(self, batch):
+        self.f.write(simplejson.dumps(batch) + '\n')
+        self.f.flush()
+
+
+class SocketSink(object):
+    """Send each batch as a line of JSON to a listening unix socket.
+
+    Batches are dropped while nothing is listening.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+
+    def emit(self, batch):
+        data = simplejson.dumps(batch) + '\n'
+
+        # If the listener went away since the last batch, the first
+        # send fails and we get one shot at reconnecting
+        for attempt in xrange(2):
+            if self.sock is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self.path)
+                except socket.error:
+                    sock.close()
+                    return
+                self.sock = sock
+
+            try:
+                self.sock.sendall(data)
+                return
+            except socket.error:
+                self.sock.close()
+                self.sock = None
+
+
+def make_sink(spec, history):
+    """Build a sink from a --sink argument."""
+    if spec == 'libnotify':
+        return LibnotifySink(history)
+    elif spec == 'json':
+        return JSONSink()
+    elif spec.startswith('socket:'):
+        return SocketSink(spec[len('socket:'):])
+    raise ValueError('Unknown sink %r' % spec)
+
+
+class SinkWorker(threading.Thread):
+    """Feed a sink from its own thread through a bounded queue.
+
+    If the sink falls behind, the "drop" policy throws away the oldest
+    queued batch once `size` are waiting. The "coalesce" policy first
+    tries to merge a batch into one already queued for the same
+    buffer, keeping at most `max_lines` lines, and only drops when
+    that isn't possible.
+    """
+
+    def __init__(self, sink, name, size=100, policy='coalesce',
+                 max_lines=10):
+        super(SinkWorker, self).__init__(name=name)
+        self.daemon = True
+        self.sink = sink
+        self.labels = (('sink', name),)
+        self.size = size
+        self.policy = policy
+        self.max_lines = max_lines
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.disabled = False
+
+        METRICS.gauge('irccloud_sink_queue_depth', lambda: len(self.queue),
+                      self.labels)
+
+    def put(self, batch):
+        with self.cond:
+            if self.disabled:
+                return
+            if self.policy == 'coalesce':
+                for queued in self.queue:
+                    if queued['bid'] == batch['bid']:
+                        queued['title'] = batch['title']
+                        queued['lines'].extend(batch['lines'])
+                        del queued['lines'][:-self.max_lines]
+                        return
+
+            if len(self.queue) >= self.size:
+                self.queue.popleft()
+                METRICS.inc('irccloud_sink_dropped_total', labels=self.labels)
+            self.queue.append(batch)
+            self.cond.notify()
+
+    def run(self):
+        # Sinks that are slow to set up do it here, while the main
+        # loop gets on with logging in
+        if hasattr(self.sink, 'open'):
+            try:
+                self.sink.open()
+            except Exception:
+                traceback.print_exc()
+                print >>sys.stderr, ("Couldn't set up the %s sink; dropping "
+                                     'its notifications' % self.name)
+                with self.cond:
+                    self.disabled = True
+                    self.queue.clear()
+                return
+
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopping:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                batch = self.queue.popleft()
+
+            start = time.time()
+            try:
+                self.sink.emit(batch)
+            except Exception:
+                traceback.print_exc()
+            METRICS.observe('irccloud_sink_emit_seconds', time.time() - start,
+                            self.labels)
+
+    def stop(self, timeout=5):
+        """Stop once whatever is already queued has been emitted."""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.join(timeout)
+
+
+class Notifier(object):
+    """Collect messages to notify about and pass them on to sinks.
+
+    Messages for a buffer are held for `window` seconds so that a
+    burst turns into a single batch, and no more than `rate` batches
+    are sent on per second across all buffers. Sinks are fed through
+    SinkWorkers, so nothing here waits on a slow notification daemon.
+    """
+
+    def __init__(self, loop, workers, window=0.5, history=10, rate=2.0):
+        self.loop = loop
+        self.workers = workers
+        self.window = window
+        self.history = history
+        self.rate = rate
+
+        # bid -> [title, lines, due], oldest first; since every entry
+        # waits the same window, that's also the order they're due in
+        self.pending = collections.OrderedDict()
+
+        # The bucket holds at least one token, or rates below one a
+        # second could never send anything
+        self.burst = max(rate, 1)
+        self.tokens = self.burst
+        self.refilled = time.time()
+        self.timer = None
+
+    def notify(self, bid, title, msg):
+        entry = self.pending.get(bid)
+        if entry is None:
+            entry = self.pending[bid] = [title, [], time.time() + self.window]
+        entry[0] = title
+        entry[1].append(msg)
+        if len(entry[1]) > self.history:
+            del entry[1][:-self.history]
+
+        self.schedule()
+
+    def schedule(self):
+        if self.timer is not None or not self.pending:
+            return
+
+        now = time.time()
+        self.refill(now)
+        due = self.pending.itervalues().next()[2]
+        delay = max(due - now, 0)
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        self.timer = self.loop.call_later(delay, self.flush)
+
+    def refill(self, now):
+        self.tokens = min(self.tokens + (now - self.refilled) * self.rate,
+                          self.burst)
+        self.refilled = now
+
+    def flush(self):
+        self.timer = None
+
+        now = time.time()
+        self.refill(now)
+
+        while self.pending and self.tokens >= 1:
+            bid, (title, lines, due) = self.pending.iteritems().next()
+            if due > now:
+                break
+            del self.pending[bid]
+            self.tokens -= 1
+            self.send(bid, title, lines, now)
+
+        self.schedule()
+
+    def send(self, bid, title, lines, now):
+        for worker in self.workers:
+            # Every worker gets its own copy, since coalescing
+            # modifies queued batches
+            worker.put({'bid': bid, 'title': title, 'lines': list(lines),
+                        'time': now})
+
+
+class LineFramer(object):
+    """Split a byte stream into newline-terminated lines.
+
+    Incoming chunks are appended to a single growable bytearray, and
+    only the newly arrived bytes are scanned for newlines, so framing
+    cost stays linear in the size of the stream no matter how large
+    the backlog burst is.
+    """
+
+    def __init__(self, on_line):
+        self.on_line = on_line
+        self.buf = bytearray()
+        self.scanned = 0
+
+    def feed(self, data):
+        buf = self.buf
+        buf.extend(data)
+
+        start = 0
+        end = buf.find('\n', self.scanned)
+        if end == -1:
+            self.scanned = len(buf)
+            return
+
+        view = memoryview(buf)
+        while end != -1:
+            self.on_line(view[start:end].tobytes())
+            start = end + 1
+            end = buf.find('\n', start)
+        # The bytearray can't be resized while a view of it is alive
+        del view
+
+        del buf[:start]
+        self.scanned = len(buf)
+
+
+# Events that update client state and must always be fully decoded
+STATE_EVENTS = frozenset(['makeserver', 'makebuffer', 'backlog_complete',
+                          'server_details_changed', 'connection_deleted',
+                          'rename_conversation', 'buffer_archived',
+                          'delete_buffer'])
+
+# Byte-level probes used to triage a line before decoding it. They
+# can't be fooled by message text, since quotes inside JSON strings
+# are always escaped.
+TYPE_RE = re.compile(r'"type"\s*:\s*"([^"]*)"')
+BID_RE = re.compile(r'"bid"\s*:\s*(-?\d+)')
+CID_RE = re.compile(r'"cid"\s*:\s*(-?\d+)')
+EID_RE = re.compile(r'"eid"\s*:\s*(-?\d+)')
+HIGHLIGHT_RE = re.compile(r'"highlight"\s*:\s*true')
+REFUSED_RE = re.compile(r'"success"\s*:\s*false')
+
+
+class Record(object):
+    """A fixed set of fields picked out of a state event.
+
+    makeserver and makebuffer events carry a lot that's never looked
+    at again, so only the fields named in __slots__ are kept.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for k in self.__slots__:
+            setattr(self, k, fields.get(k))
+
+    def update(self, ev):
+        for k in self.__slots__:
+            if k in ev:
+                setattr(self, k, ev[k])
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+
+class Server(Record):
+    __slots__ = ('cid', 'name')
+
+
+class Buffer(Record):
+    __slots__ = ('bid', 'cid', 'name', 'buffer_type', 'hidden')
+
+
+class KeywordMatcher(object):
+    """Aho-Corasick automaton for finding any of a set of substrings.
+
+    Every keyword carries a tag, and a search only counts keywords
+    whose tag is in the set it's given. Matching walks the text once,
+    so its cost depends on the length of the text but not on how many
+    keywords there are.
+    """
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [None]
+
+        for keyword, tag in keywords:
+            state = 0
+            for ch in keyword:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = self.goto[state][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(None)
+                state = nxt
+            self.out[state] = (self.out[state] or frozenset()) | set([tag])
+
+        queue = collections.deque(self.goto[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].iteritems():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                inherited = self.out[self.fail[nxt]]
+                if inherited:
+                    self.out[nxt] = (self.out[nxt] or frozenset()) | inherited
+
+    def search(self, text, tags):
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for ch in text:
+            nxt = goto[state].get(ch)
+            while nxt is None and state:
+                state = fail[state]
+                nxt = goto[state].get(ch)
+            state = nxt or 0
+
+            tagged = out[state]
+            if tagged and not tagged.isdisjoint(tags):
+                return True
+        return False
+
+
+class Patterns(object):
+    """Regexes matched against a message and globs against its sender."""
+
+    def __init__(self, regexes=(), nicks=()):
+        self.regex = self.nicks = None
+
+        if regexes:
+            self.regex = re.compile('|'.join('(?:%s)' % r for r in regexes),
+                                    re.I | re.U)
+        if nicks:
+            self.nicks = re.compile('|'.join(fnmatch.translate(n)
+                                             for n in nicks),
+                                    re.I)
+
+    def matches(self, ev):
+        if self.regex and self.regex.search(ev['msg']):
+            return True
+        if self.nicks and self.nicks.match(ev.get('from') or ''):
+            return True
+        return False
+
+
+class RuleEngine(object):
+    """User-defined notification rules, loaded from a JSON file.
+
+    The file looks like:
+
+        {"keywords": ["deploy"], "regexes": ["build (failed|broke)"],
+         "nicks": ["ops-*"],
+         "include": ["freenode"], "exclude": ["freenode/#random"],
+         "scopes": {"freenode/#ops": {"keywords": ["page"]}}}
+
+    Scopes are a network name, or a network and buffer name joined
+    with a slash. Keywords, regexes and nicks at the top level apply
+    everywhere, and the ones under "scopes" only apply there. Keywords
+    match anywhere in a message, ignoring case; nicks are shell-style
+    globs matched against the sender. Nothing in an excluded scope
+    ever notifies, and if "include" is given, nothing outside it does
+    either.
+
+    The keywords from every scope are compiled into one automaton, and
+    the scopes that apply to each buffer are looked up by (cid, bid).
+    """
+
+    def __init__(self, config):
+        scopes = dict(config.get('scopes', {}))
+        scopes[None] = config
+
+        keywords = []
+        self.patterns = {}
+        for scope, rules in scopes.iteritems():
+            keywords.extend((k.lower(), scope)
+                            for k in rules.get('keywords', ()) if k)
+            if rules.get('regexes') or rules.get('nicks'):
+                self.patterns[scope] = Patterns(rules.get('regexes', ()),
+                                                rules.get('nicks', ()))
+        self.keywords = KeywordMatcher(keywords)
+
+        self.include = frozenset(config.get('include', ()))
+        self.exclude = frozenset(config.get('exclude', ()))
+        # (cid, bid) -> (network name, buffer name, scopes)
+        self.index = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(simplejson.load(f))
+
+    def lookup(self, server, buf):
+        """Return the scopes a buffer is in, or None if it's muted."""
+        key = (buf.cid, buf.bid)
+        cached = self.index.get(key)
+        # Buffers and networks can be renamed, which moves them
+        # between scopes
+        if cached and cached[0] == server.name and cached[1] == buf.name:
+            return cached[2]
+
+        names = (server.name, '%s/%s' % (server.name, buf.name))
+        if self.exclude.intersection(names):
+            scopes = None
+        elif self.include and not self.include.intersection(names):
+            scopes = None
+        else:
+            scopes = frozenset((None,) + names)
+
+        self.index[key] = (server.name, buf.name, scopes)
+        return scopes
+
+    def check(self, server, buf, ev, default):
+        """Decide whether ev should notify.
+
+        default is whether it would without any rules loaded.
+        """
+        scopes = self.lookup(server, buf)
+        if scopes is None:
+            return False
+        if default:
+            return True
+        if ev.get('self', False):
+            return False
+
+        if self.keywords.search(ev['msg'].lower(), scopes):
+            return True
+        for scope in scopes:
+            patterns = self.patterns.get(scope)
+            if patterns and patterns.matches(ev):
+                return True
+        return False
 
 
 class StreamHandler(object):
-    def __init__(self):
-        self.buffer = ''
+    def __init__(self, notifier, rules=None, backlog_workers=0):
+        self.notifier = notifier
+        self.rules = rules
+        self.backlog_workers = backlog_workers
+        self.backlog_pool = None
+        self.framer = LineFramer(self.on_line)
         self.servers = {}
         self.buffers = {}
-        self.notifications = collections.defaultdict(IRCCloudNotification)
         self.past_backlog = False
+        self.last_eid = 0
+        self.dirty = False
+        self.connected = time.time()
+        # Callables that get to see every line, as (line, type)
+        self.taps = []
+
+        # Counted here rather than in METRICS to keep on_line cheap
+        self.received_bytes = 0
+        self.received_chunks = 0
+        self.line_counts = collections.defaultdict(int)
+        METRICS.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        counts = [(('irccloud_received_bytes_total', ()), self.received_bytes),
+                  (('irccloud_received_chunks_total', ()),
+                   self.received_chunks)]
+        for kind, count in dict(self.line_counts).iteritems():
+            labels = (('type', kind or 'unknown'),)
+            counts.append((('irccloud_lines_total', labels), count))
+        return counts
+
+    def reset(self):
+        """Prepare for a new connection to the stream."""
+        self.framer = LineFramer(self.on_line)
+        self.past_backlog = False
+        self.connected = time.time()
+        self.drain()
+        if self.backlog_workers:
+            self.backlog_pool = BacklogPool(self, self.notifier.loop,
+                                            self.backlog_workers)
+
+    def drain(self):
+        """Finish off whatever the last connection left with the pool."""
+        if self.backlog_pool:
+            self.backlog_pool.drain()
+            self.backlog_pool = None
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'last_eid': self.last_eid,
+            'servers': [s.to_dict() for s in self.servers.itervalues()],
+            'buffers': [b.to_dict() for b in self.buffers.itervalues()],
+            }
+
+    def restore(self, snap):
+        self.servers = dict((s['cid'], Server(**s)) for s in snap['servers'])
+        self.buffers = dict((b['bid'], Buffer(**b)) for b in snap['buffers'])
+        self.last_eid = snap['last_eid']
+        self.dirty = False
 
     def on_receive(self, data):
-        self.buffer += data
-        if '\n' in self.buffer:
-            lines = self.buffer.split('\n')
-            self.buffer = lines.pop()
-            for line in lines:
-                self.on_line(line)
+        self.received_bytes += len(data)
+        self.received_chunks += 1
+        if self.backlog_pool:
+            self.backlog_pool.feed(data)
+        else:
+            self.framer.feed(data)
+
+    def wants_line(self, line, kind):
+        """Decide from the raw line whether it's worth decoding.
+
+        kind is the event type as found by TYPE_RE, if any. This has
+        to err on the side of True; anything it can't classify is
+        passed on to the full decoder.
+        """
+        if kind is None or kind in STATE_EVENTS:
+            return True
+
+        if not self.past_backlog:
+            return False
+        if '"msg"' not in line:
+            return False
+        if HIGHLIGHT_RE.search(line):
+            return True
+
+        m = BID_RE.search(line)
+        if not m:
+            return True
+        buf = self.buffers.get(int(m.group(1)))
+        if buf is None:
+            return False
+        if self.rules:
+            server = self.servers.get(buf.cid)
+            return (server is not None and
+                    self.rules.lookup(server, buf) is not None)
+        return buf.buffer_type == 'conversation'
 
     def on_line(self, line):
         if not line:
             return
 
+        m = TYPE_RE.search(line)
+        kind = m and m.group(1)
+        self.line_counts[kind] += 1
+        for tap in self.taps:
+            tap(line, kind)
+
+        m = EID_RE.search(line)
+        if m:
+            eid = int(m.group(1))
+            if eid > self.last_eid:
+                self.last_eid = eid
+                self.dirty = True
+
+        if not self.wants_line(line, kind):
+            return
+
+        start = time.time()
         ev = simplejson.loads(line)
+        METRICS.observe('irccloud_decode_seconds', time.time() - start,
+                        (('type', kind or 'unknown'),))
+        self.dispatch(ev)
 
-        if ev['type'] == 'makeserver':
+    def dispatch(self, ev):
+        # Not every line is an event; a stream that won't take our
+        # session is refused with a bare {"success":false}
+        kind = ev.get('type')
+        if kind == 'makeserver':
             # {"bid":-1, "eid":-1, "type":"makeserver", "time":-1,
             # "highlight":false, "cid":1709, "name":"IRCCloud",
             # "nick":"ebroder", "nickserv_nick":"ebroder",
@@ -79,15 +921,38 @@ class StreamHandler(object):
             # "hostname":"irc.irccloud.com", "port":6667, "away":"",
             # "disconnected":false, "away_timeout":0, "autoback":true,
             # "ssl":false, "server_pass":""}
-            self.servers[ev['cid']] = ev
-        elif ev['type'] == 'makebuffer':
+            self.servers[ev['cid']] = Server(**ev)
+            self.dirty = True
+        elif kind == 'server_details_changed':
+            server = self.servers.get(ev['cid'])
+            if server:
+                server.update(ev)
+                self.dirty = True
+        elif kind == 'connection_deleted':
+            self.servers.pop(ev['cid'], None)
+            for bid, buf in self.buffers.items():
+                if buf.cid == ev['cid']:
+                    del self.buffers[bid]
+            self.dirty = True
+        elif kind == 'makebuffer':
             # {"bid":11162, "eid":-1, "type":"makebuffer", "time":-1,
             # "highlight":false, "name":"*", "buffer_type":"console",
             # "cid":1709, "max_eid":83, "focus":true,
             # "last_seen_eid":41, "joined":false, "hidden":false}
-            self.buffers[ev['bid']] = ev
-        elif ev['type'] == 'backlog_complete':
+            self.buffers[ev['bid']] = Buffer(**ev)
+            self.dirty = True
+        elif kind == 'rename_conversation':
+            buf = self.buffers.get(ev['bid'])
+            if buf:
+                buf.name = ev['new_name']
+                self.dirty = True
+        elif kind in ('buffer_archived', 'delete_buffer'):
+            self.buffers.pop(ev['bid'], None)
+            self.dirty = True
+        elif kind == 'backlog_complete':
             self.past_backlog = True
+            METRICS.observe('irccloud_backlog_seconds',
+                            time.time() - self.connected)
         elif 'msg' in ev:
             if not self.past_backlog:
                 return
@@ -96,103 +961,1521 @@ class StreamHandler(object):
             if not buf:
                 return
 
-            server = self.servers.get(buf['cid'])
+            server = self.servers.get(buf.cid)
             if not server:
                 return
 
-            if ((buf['buffer_type'] == 'conversation' and not ev.get('self', False)) or
-                ev['highlight']):
-                title = '%s (%s)' % (buf['name'], server['name'])
+            notify = ((buf.buffer_type == 'conversation' and
+                       not ev.get('self', False)) or
+                      ev['highlight'])
+            if self.rules:
+                notify = self.rules.check(server, buf, ev, notify)
 
-                n = self.notifications[ev['bid']]
-                n.update(title, ev['msg'])
-                n.show()
+            if notify:
+                title = '%s (%s)' % (buf.name, server.name)
+                self.notifier.notify(ev['bid'], title, ev['msg'])
 
 
-class CurlManager(object):
-    def __init__(self, multi):
-        self.m = multi
-        self.watches = []
+def triage_backlog(data, want_kinds):
+    """Do on_line's work for a batch of backlog lines, in a pool worker.
 
-        self.glib_cb()
+    Returns the number of lines of each type, the highest eid, the
+    decoded state events and, if want_kinds, the type of every line.
+    It stops after backlog_complete, and the last thing returned is
+    the rest of data, untouched.
+    """
+    counts = collections.defaultdict(int)
+    kinds = [] if want_kinds else None
+    events = []
+    last_eid = 0
+    lines = data.split('\n')
+    for i, line in enumerate(lines):
+        if not line:
+            continue
 
-    def glib_cb(self, source=None, cond=None):
-        while True:
-            if not self.watches:
+        m = TYPE_RE.search(line)
+        kind = m and m.group(1)
+        counts[kind] += 1
+        if kinds is not None:
+            kinds.append(kind)
+
+        m = EID_RE.search(line)
+        if m:
+            eid = int(m.group(1))
+            if eid > last_eid:
+                last_eid = eid
+
+        if kind is None or kind in STATE_EVENTS:
+            events.append(simplejson.loads(line))
+            if kind == 'backlog_complete':
+                return (dict(counts), last_eid, events, kinds,
+                        '\n'.join(lines[i + 1:]))
+    return dict(counts), last_eid, events, kinds, ''
+
+
+class BacklogPool(object):
+    """Triage a StreamHandler's backlog in worker processes.
+
+    Complete lines are cut into batches of about BATCH_SIZE bytes and
+    handed to a multiprocessing.Pool, and the results are applied on
+    the main loop in stream order. Once backlog_complete turns up,
+    everything from there on waits behind the outstanding batches and
+    goes through the handler's own framer, and when the last batch is
+    in the pool is shut down.
+    """
+
+    BATCH_SIZE = 256 * 1024
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, sh, loop, workers):
+        import multiprocessing
+
+        self.sh = sh
+        self.loop = loop
+        self.pool = multiprocessing.Pool(workers)
+        self.partial = ''
+        self.batch = []
+        self.batch_size = 0
+        # (data, AsyncResult) for batches and plain strings for data
+        # past the backlog, in stream order
+        self.queue = collections.deque()
+        self.done = False
+        self.timer = self.loop.call_later(self.POLL_INTERVAL, self.poll)
+
+    def feed(self, data):
+        if self.done:
+            self.queue.append(data)
+            return
+
+        # Look in the partial line too, in case the chunk boundary
+        # fell inside it. A message could quote this as well, which
+        # only means the rest of the backlog is handled on the main
+        # loop.
+        data = self.partial + data
+        self.partial = ''
+        if '"backlog_complete"' in data:
+            self.submit()
+            self.queue.append(data)
+            self.done = True
+            return
+
+        cut = data.rfind('\n') + 1
+        self.partial = data[cut:]
+        if cut:
+            self.batch.append(data[:cut])
+            self.batch_size += cut
+            if self.batch_size >= self.BATCH_SIZE:
+                self.submit()
+
+    def submit(self):
+        if not self.batch:
+            return
+        data = ''.join(self.batch)
+        self.batch = []
+        self.batch_size = 0
+        result = self.pool.apply_async(triage_backlog,
+                                       (data, bool(self.sh.taps)))
+        self.queue.append((data, result))
+
+    def apply(self, data, result):
+        counts, last_eid, events, kinds, rest = result
+        sh = self.sh
+        for kind, count in counts.iteritems():
+            sh.line_counts[kind] += count
+        if sh.taps:
+            head = data[:len(data) - len(rest)]
+            lines = [line for line in head.split('\n') if line]
+            for line, kind in itertools.izip(lines, kinds):
+                for tap in sh.taps:
+                    tap(line, kind)
+        if last_eid > sh.last_eid:
+            sh.last_eid = last_eid
+            sh.dirty = True
+        for ev in events:
+            sh.dispatch(ev)
+
+        # backlog_complete got past feed(), so everything after it is
+        # live and goes through the framer from here on
+        if sh.past_backlog and not self.done:
+            sh.framer.feed(rest)
+            self.queue.append(''.join(self.batch) + self.partial)
+            self.batch = []
+            self.batch_size = 0
+            self.partial = ''
+            self.done = True
+
+    def handle(self, item):
+        if isinstance(item, str):
+            self.sh.framer.feed(item)
+        elif self.sh.past_backlog:
+            # Sent to the pool before backlog_complete was found
+            self.sh.framer.feed(item[0])
+        else:
+            self.apply(item[0], item[1].get())
+
+    def poll(self):
+        # Don't leave a short batch waiting on a quiet stream
+        if not self.done:
+            self.submit()
+
+        while self.queue:
+            item = self.queue[0]
+            if not isinstance(item, str) and not item[1].ready():
                 break
-            glib.source_remove(self.watches.pop())
+            self.queue.popleft()
+            self.handle(item)
 
-        self.m.perform()
+        if self.done and not self.queue:
+            self.timer = None
+            self.sh.backlog_pool = None
+            self.pool.close()
+        else:
+            self.timer = self.loop.call_later(self.POLL_INTERVAL, self.poll)
 
-        infds, outfds, errfds = self.m.fdset()
+    def drain(self):
+        """Wait for and apply everything still queued, and shut down."""
+        if self.timer:
+            self.loop.cancel(self.timer)
+            self.timer = None
+        if not self.done:
+            self.submit()
+        while self.queue:
+            self.handle(self.queue.popleft())
+        self.pool.close()
 
-        for fdset, cond in ((infds, glib.IO_IN),
-                            (outfds, glib.IO_OUT),
-                            (errfds, glib.IO_ERR)):
-            for fd in fdset:
-                self.watches.append(glib.io_add_watch(fd, cond, self.glib_cb))
 
-        return False
+# Event masks used by the event loops
+READ = 1
+WRITE = 2
+ERROR = 4
+
+
+class GlibLoop(object):
+    """Event loop backed by the glib main loop, for use with GTK."""
+
+    def __init__(self):
+        global glib
+        import glib
+
+        # Sink workers need the main loop to let go of the GIL
+        glib.threads_init()
+        self.mainloop = glib.MainLoop()
+        self.watches = {}
+
+    def watch(self, fd, events, callback):
+        """Call callback(fd, events) whenever fd is ready.
+
+        Replaces any existing watch on fd.
+        """
+        self.unwatch(fd)
+
+        cond = glib.IO_ERR | glib.IO_HUP
+        if events & READ:
+            cond |= glib.IO_IN | glib.IO_PRI
+        if events & WRITE:
+            cond |= glib.IO_OUT
+        self.watches[fd] = glib.io_add_watch(fd, cond, self.glib_cb, callback)
 
+    def unwatch(self, fd):
+        source = self.watches.pop(fd, None)
+        if source is not None:
+            glib.source_remove(source)
 
-def parse_options():
+    def glib_cb(self, fd, cond, callback):
+        events = 0
+        if cond & (glib.IO_IN | glib.IO_PRI | glib.IO_HUP):
+            events |= READ
+        if cond & glib.IO_OUT:
+            events |= WRITE
+        if cond & glib.IO_ERR:
+            events |= ERROR
+        callback(fd, events)
+        return True
+
+    def call_later(self, delay, callback, *args):
+        timer = [None]
+
+        def fire():
+            timer[0] = None
+            callback(*args)
+            return False
+        timer[0] = glib.timeout_add(int(delay * 1000), fire)
+
+        return timer
+
+    def cancel(self, timer):
+        if timer[0] is not None:
+            glib.source_remove(timer[0])
+            timer[0] = None
+
+    def run(self):
+        self.mainloop.run()
+
+    def stop(self):
+        self.mainloop.quit()
+
+
+class PollLoop(object):
+    """Event loop on top of epoll (or poll), for running without GTK."""
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.timeout_scale = 1
+        else:
+            self.poller = select.poll()
+            self.timeout_scale = 1000
+        self.watches = {}
+        self.timers = []
+        self.seq = itertools.count()
+        self.running = False
+
+    def watch(self, fd, events, callback):
+        mask = select.POLLERR | select.POLLHUP
+        if events & READ:
+            mask |= select.POLLIN | select.POLLPRI
+        if events & WRITE:
+            mask |= select.POLLOUT
+
+        if fd in self.watches:
+            self.poller.modify(fd, mask)
+        else:
+            self.poller.register(fd, mask)
+        self.watches[fd] = callback
+
+    def unwatch(self, fd):
+        if self.watches.pop(fd, None) is not None:
+            self.poller.unregister(fd)
+
+    def call_later(self, delay, callback, *args):
+        timer = [callback, args]
+        heapq.heappush(self.timers,
+                       (time.time() + delay, next(self.seq), timer))
+        return timer
+
+    def cancel(self, timer):
+        timer[0] = None
+
+    def run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.timers)
+            callback, args = timer
+            if callback is not None:
+                timer[0] = None
+                callback(*args)
+
+    def run(self):
+        self.running = True
+        while self.running:
+            if self.timers:
+                timeout = max(self.timers[0][0] - time.time(), 0)
+                timeout *= self.timeout_scale
+            else:
+                timeout = -1
+
+            try:
+                ready = self.poller.poll(timeout)
+            except (IOError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, mask in ready:
+                callback = self.watches.get(fd)
+                if callback is None:
+                    continue
+
+                events = 0
+                if mask & (select.POLLIN | select.POLLPRI | select.POLLHUP):
+                    events |= READ
+                if mask & select.POLLOUT:
+                    events |= WRITE
+                if mask & select.POLLERR:
+                    events |= ERROR
+                callback(fd, events)
+
+            self.run_timers()
+
+    def stop(self):
+        self.running = False
+
+
+LOOPS = {
+    'glib': GlibLoop,
+    'poll': PollLoop,
+    }
+
+
+class CurlManager(object):
+    """Drive a CurlMulti from an event loop using curl's socket API.
+
+    curl tells us which sockets it cares about through the socket
+    callback and when it next needs to be woken up through the timer
+    callback, so watches persist across wakeups and are only changed
+    when curl asks for it.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.m = pycurl.CurlMulti()
+        self.m.setopt(pycurl.M_SOCKETFUNCTION, self.socket_cb)
+        self.m.setopt(pycurl.M_TIMERFUNCTION, self.timer_cb)
+        self.timer = None
+        # Hold references to the Curl objects ourselves, because
+        # pycurl is too dumb to
+        self.handles = {}
+        # Connections are already pooled by the CurlMulti; this lets
+        # transfers share DNS lookups and TLS sessions as well
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+    def curl(self):
+        """Make a Curl object that shares what it can with the others."""
+        c = pycurl.Curl()
+        c.setopt(pycurl.SHARE, self.share)
+        return c
+
+    def add(self, c, on_done):
+        """Start a transfer; on_done(c, err, errmsg) is called when it ends.
+
+        err is None if the transfer completed successfully.
+        """
+        self.handles[c] = on_done
+        self.m.add_handle(c)
+
+    def socket_cb(self, what, fd, multi, data):
+        if what == pycurl.POLL_REMOVE:
+            self.loop.unwatch(fd)
+            return
+
+        events = 0
+        if what in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+            events |= READ
+        if what in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+            events |= WRITE
+        self.loop.watch(fd, events, self.io_cb)
+
+    def timer_cb(self, timeout_ms):
+        if self.timer is not None:
+            self.loop.cancel(self.timer)
+            self.timer = None
+
+        if timeout_ms >= 0:
+            self.timer = self.loop.call_later(timeout_ms / 1000.0,
+                                              self.on_timeout)
+
+    def on_timeout(self):
+        self.timer = None
+        self.action(pycurl.SOCKET_TIMEOUT, 0)
+
+    def io_cb(self, fd, events):
+        mask = 0
+        if events & READ:
+            mask |= pycurl.CSELECT_IN
+        if events & WRITE:
+            mask |= pycurl.CSELECT_OUT
+        if events & ERROR:
+            mask |= pycurl.CSELECT_ERR
+        self.action(fd, mask)
+
+    def action(self, fd, mask):
+        while True:
+            ret, running = self.m.socket_action(fd, mask)
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+
+        while True:
+            queued, ok, failed = self.m.info_read()
+            for c in ok:
+                self.finish(c, None, None)
+            for c, err, errmsg in failed:
+                self.finish(c, err, errmsg)
+            if not queued:
+                break
+
+    def finish(self, c, err, errmsg):
+        self.m.remove_handle(c)
+        on_done = self.handles.pop(c)
+        on_done(c, err, errmsg)
+
+
+def parse_options(args=None):
     p = optparse.OptionParser()
     p.add_option('-e', '--email',
                  dest='email')
     p.add_option('-p', '--password',
                  dest='password')
+    p.add_option('--base-url',
+                 dest='base_url',
+                 default='https://irccloud.com',
+                 help='Where to find /chat/login and /chat/stream')
+    p.add_option('-a', '--accounts',
+                 dest='accounts',
+                 help='File listing one "email password" pair per line, '
+                 'to watch several accounts at once')
+    p.add_option('--loop',
+                 dest='loop',
+                 type='choice',
+                 choices=sorted(LOOPS),
+                 default='glib',
+                 help='Event loop to run on; "poll" runs without GTK')
+    p.add_option('--rules',
+                 dest='rules',
+                 help='JSON file of extra notification rules')
+    p.add_option('--coalesce',
+                 dest='coalesce',
+                 type='float',
+                 default=0.5,
+                 help='Seconds to collect messages for a buffer before '
+                 'updating its notification')
+    p.add_option('--history',
+                 dest='history',
+                 type='int',
+                 default=10,
+                 help='Number of lines each notification shows')
+    p.add_option('--rate-limit',
+                 dest='rate_limit',
+                 type='float',
+                 default=2.0,
+                 help='Maximum notifications shown per second')
+    p.add_option('--sink',
+                 dest='sinks',
+                 action='append',
+                 help='Where to send notifications: "libnotify", "json" '
+                 '(stdout) or "socket:PATH"; may be repeated')
+    p.add_option('--queue-size',
+                 dest='queue_size',
+                 type='int',
+                 default=100,
+                 help='Notifications each sink may fall behind by')
+    p.add_option('--queue-policy',
+                 dest='queue_policy',
+                 type='choice',
+                 choices=['coalesce', 'drop'],
+                 default='coalesce',
+                 help='What to do when a sink falls behind')
+    p.add_option('--no-compression',
+                 dest='compression',
+                 action='store_false',
+                 default=True,
+                 help="Don't ask for the stream to be compressed")
+    p.add_option('--session-max-age',
+                 dest='session_max_age',
+                 type='int',
+                 default=86400,
+                 help='Log in again rather than reuse a session cached in '
+                 '--state-dir that is older than this many seconds')
+    p.add_option('--backlog-workers',
+                 dest='backlog_workers',
+                 type='int',
+                 default=0,
+                 help='Processes to sort through the backlog with, '
+                 'leaving the main loop free (default: none)')
+    p.add_option('--metrics-port',
+                 dest='metrics_port',
+                 type='int',
+                 help='Serve metrics on http://localhost:PORT/metrics')
+    p.add_option('--record',
+                 dest='record',
+                 metavar='DIR',
+                 help='Save each raw stream to DIR/EMAIL.stream, for '
+                 'irccloud-replay.py')
+    p.add_option('--relay',
+                 dest='relay',
+                 metavar='DIR',
+                 help='Serve each stream to local clients on the unix '
+                 'socket DIR/EMAIL.sock')
+    p.add_option('--relay-buffer',
+                 dest='relay_buffer',
+                 type='int',
+                 default=1024 * 1024,
+                 help='Bytes a relay client may fall behind by before it '
+                 'is disconnected')
+    p.add_option('--from-relay',
+                 dest='relay_sources',
+                 metavar='SOCKET',
+                 action='append',
+                 help="Follow another process's --relay socket instead of "
+                 'logging in; may be repeated')
+    p.add_option('--archive',
+                 dest='archive',
+                 metavar='DIR',
+                 help='Keep an indexed archive of each stream in DIR/EMAIL/')
+    p.add_option('--archive-tail',
+                 dest='archive_tail',
+                 type='int',
+                 metavar='BID',
+                 help="Print the end of a buffer's archive and exit")
+    p.add_option('--archive-lines',
+                 dest='archive_lines',
+                 type='int',
+                 default=20,
+                 help='Number of lines --archive-tail prints')
+    p.add_option('--archive-highlights',
+                 dest='archive_highlights',
+                 type='float',
+                 metavar='SINCE',
+                 help='Print archived highlights since a unix time, or '
+                 'since this many seconds ago if negative, and exit')
+    p.add_option('--state-dir',
+                 dest='state_dir',
+                 default=CACHE_DIR,
+                 help='Where to keep state snapshots (empty to disable)')
+    p.add_option('--state-max-age',
+                 dest='state_max_age',
+                 type='int',
+                 default=3600,
+                 help='Replay the full backlog if the snapshot is older '
+                 'than this many seconds')
 
-    opts, args = p.parse_args()
+    opts, args = p.parse_args(args)
 
-    if not opts.email or not opts.password:
+    opts.query = (opts.archive_tail is not None or
+                  opts.archive_highlights is not None)
+    if opts.query:
+        if not opts.archive or not opts.email:
+            p.error('Archive queries need --archive and --email')
+    elif opts.accounts:
+        if opts.email or opts.password:
+            p.error("Can't combine --accounts with --email/--password")
+    elif opts.relay_sources:
+        if opts.email or opts.password:
+            p.error("Can't combine --from-relay with --email/--password")
+    elif not opts.email or not opts.password:
         p.error('Must specify both an email and a password')
 
+    if not opts.sinks:
+        opts.sinks = ['libnotify']
+    for spec in opts.sinks:
+        if spec not in ('libnotify', 'json') and not spec.startswith('socket:'):
+            p.error('Unknown sink %r' % spec)
+
+    if opts.rate_limit <= 0:
+        p.error('--rate-limit must be more than 0')
+
     return opts
 
 
-def get_session(opts):
-    resp = urllib2.urlopen('https://irccloud.com/chat/login',
-                           urllib.urlencode([('email', opts.email),
-                                             ('password', opts.password)]))
-    auth = simplejson.load(resp)
-    if not auth['success']:
-        print >>sys.stderr, 'Authentication failure'
-        sys.exit(1)
+def read_accounts(path):
+    accounts = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 1)
+            if len(fields) != 2:
+                raise ValueError('line %d: expected "email password"' %
+                                 lineno)
+            accounts.append(tuple(fields))
+    return accounts
+
+
+def get_session(base_url, email, password, cm, on_done, c=None):
+    """Log in without blocking.
+
+    on_done(auth) is called with the decoded login response, or with
+    None if the request itself failed. Pass in a Curl object to reuse
+    its connection.
+    """
+    body = cStringIO.StringIO()
+
+    if c is None:
+        c = pycurl.Curl()
+    c.setopt(pycurl.URL, base_url + '/chat/login')
+    c.setopt(pycurl.POSTFIELDS, urllib.urlencode([('email', email),
+                                                  ('password', password)]))
+    c.setopt(pycurl.WRITEFUNCTION, body.write)
+
+    def login_done(c, err, errmsg):
+        auth = None
+        if err is None:
+            try:
+                auth = simplejson.loads(body.getvalue())
+            except ValueError:
+                pass
+        on_done(auth)
+
+    cm.add(c, login_done)
+    return c
+
+
+def state_path(state_dir, email):
+    if not state_dir:
+        return None
+    return os.path.join(state_dir, '%s.json' % email)
+
+
+def load_state(path, max_age):
+    """Return a saved snapshot, or None if there's no usable one."""
+    try:
+        with open(path) as f:
+            snap = simplejson.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if time.time() - snap.get('time', 0) > max_age:
+        return None
+
+    return snap
+
+
+def save_state(path, sh):
+    try:
+        os.makedirs(os.path.dirname(path), 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        simplejson.dump(sh.snapshot(), f)
+    os.rename(tmp, path)
+    sh.dirty = False
+
+
+class StateSaver(object):
+    """Periodically write a StreamHandler's snapshot to disk."""
+
+    def __init__(self, loop, path, sh, interval=60):
+        self.loop = loop
+        self.path = path
+        self.sh = sh
+        self.interval = interval
+        self.loop.call_later(self.interval, self.tick)
+
+    def save(self):
+        # Only snapshot state that the server has finished sending us
+        if self.sh.past_backlog and self.sh.dirty:
+            save_state(self.path, self.sh)
+
+    def tick(self):
+        self.save()
+        self.loop.call_later(self.interval, self.tick)
+
+
+def session_path(state_dir, email):
+    if not state_dir:
+        return None
+    return os.path.join(state_dir, '%s.session' % email)
+
+
+def load_session(path, max_age):
+    """Return a cached session cookie, or None if there's no usable one."""
+    try:
+        with open(path) as f:
+            cached = simplejson.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if time.time() - cached.get('time', 0) > max_age:
+        return None
+
+    return cached.get('session')
+
+
+def save_session(path, session):
+    try:
+        os.makedirs(os.path.dirname(path), 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # The cookie is as good as the password, so it's never readable
+    # by anyone else, not even for a moment
+    tmp = path + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, 'w') as f:
+        simplejson.dump({'time': time.time(), 'session': session}, f)
+    os.rename(tmp, path)
+
+
+def forget_session(path):
+    try:
+        os.unlink(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class Archive(object):
+    """An append-only, indexed log of one account's stream.
+
+    Lines are collected into blocks of up to BLOCK_LINES, and each
+    block is zlib-compressed and appended to the current segment,
+    NNNNNNNN.log. Two indexes of fixed-size records sit next to each
+    segment. NNNNNNNN.tix has each block's offset, length, arrival time
+    range and highlight count, in the order they were written.
+    NNNNNNNN.bix has a (bid, block, highest eid) record for every
+    buffer with lines in a block. A block only exists once its .tix
+    record has been written. Queries mmap the segments and decompress
+    just the blocks the indexes point them at.
+
+    Given the StreamHandler it's archiving, the archive also writes a
+    checkpoint of its state at every backlog_complete. The checkpoint
+    goes at the start of a block, so restoring only has to replay the
+    state events after the latest one.
+    """
+
+    BLOCK_LINES = 1024
+    FLUSH_INTERVAL = 5
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    TIX = struct.Struct('<QIddI')
+    BIX = struct.Struct('<qqq')
+    # State events are indexed under this bid; irccloud itself only
+    # uses -1 for "no buffer"
+    STATE = -2
+    CHECKPOINT = -3
+    # Chatter that isn't worth keeping
+    SKIP = frozenset(['header', 'idle', 'heartbeat_echo'])
+
+    def __init__(self, path, loop=None, sh=None):
+        self.path = path
+        self.sh = sh
+        try:
+            os.makedirs(path, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # (segment, offset, length, first, last, highlights) per block
+        self.blocks = []
+        # Arrival time of each block's last line, for bisecting
+        self.times = []
+        self.bid_blocks = collections.defaultdict(list)
+        self.bid_eids = {}
+        self.last_eid = 0
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(path)
+                               if name.endswith('.tix'))
+        for seg in self.segments:
+            self.load_segment(seg)
+
+        self.maps = {}
+        self.files = None
+        self.seg_blocks = 0
+        self.pending = []
+        self.pending_bids = {}
+        self.pending_first = self.pending_last = 0
+        self.pending_highlights = 0
+
+        self.loop = loop
+        if loop:
+            loop.call_later(self.FLUSH_INTERVAL, self.tick)
+
+    def segment_file(self, seg, ext):
+        return os.path.join(self.path, '%08d.%s' % (seg, ext))
+
+    def load_segment(self, seg):
+        with open(self.segment_file(seg, 'tix'), 'rb') as f:
+            tix = f.read()
+        base = len(self.blocks)
+        for i in xrange(len(tix) // self.TIX.size):
+            off, length, first, last, highlights = self.TIX.unpack_from(
+                tix, i * self.TIX.size)
+            self.blocks.append((seg, off, length, first, last, highlights))
+            self.times.append(last)
+
+        try:
+            with open(self.segment_file(seg, 'bix'), 'rb') as f:
+                bix = f.read()
+        except IOError:
+            bix = ''
+        for i in xrange(len(bix) // self.BIX.size):
+            bid, block, eid = self.BIX.unpack_from(bix, i * self.BIX.size)
+            # Left over from a block that was never finished
+            if base + block >= len(self.blocks):
+                break
+            self.bid_blocks[bid].append(base + block)
+            if eid > self.bid_eids.get(bid, 0):
+                self.bid_eids[bid] = eid
+            if eid > self.last_eid:
+                self.last_eid = eid
+
+    @property
+    def updated(self):
+        """When the newest archived line arrived."""
+        return self.times[-1] if self.times else 0
+
+    def append(self, line, kind):
+        """Archive a line; this is a StreamHandler tap."""
+        if kind in self.SKIP:
+            return
+        if kind == 'backlog_complete' and self.sh:
+            self.checkpoint()
+
+        eid = 0
+        if kind in STATE_EVENTS:
+            bid = self.STATE
+        else:
+            m = BID_RE.search(line)
+            bid = m and int(m.group(1))
+            m = EID_RE.search(line)
+            if bid is not None and m:
+                eid = int(m.group(1))
+                # Already archived from an earlier connection
+                if 0 < eid <= self.bid_eids.get(bid, 0):
+                    return
+        self.add(line, bid, eid)
+
+    def checkpoint(self):
+        # Taps run before the line is dispatched, so this is the state
+        # from just before backlog_complete
+        self.flush()
+        snap = self.sh.snapshot()
+        snap['type'] = 'archive_checkpoint'
+        self.add(simplejson.dumps(snap), self.CHECKPOINT, 0)
+
+    def add(self, line, bid, eid):
+        now = time.time()
+        if not self.pending:
+            self.pending_first = now
+        self.pending_last = now
+        self.pending.append(line)
+        if bid is not None:
+            if eid > 0:
+                self.bid_eids[bid] = eid
+                if eid > self.last_eid:
+                    self.last_eid = eid
+            if eid >= self.pending_bids.get(bid, 0):
+                self.pending_bids[bid] = eid
+        if HIGHLIGHT_RE.search(line):
+            self.pending_highlights += 1
+
+        if len(self.pending) >= self.BLOCK_LINES:
+            self.flush()
+
+    def open_segment(self):
+        if self.files:
+            for f in self.files:
+                f.close()
+
+        if self.segments and self.files is None:
+            # Carry on with the newest segment, cutting off anything a
+            # crash left half-written
+            seg = self.segments[-1]
+            self.seg_blocks = sum(1 for b in self.blocks if b[0] == seg)
+            with open(self.segment_file(seg, 'tix'), 'r+b') as f:
+                f.truncate(self.seg_blocks * self.TIX.size)
+            with open(self.segment_file(seg, 'bix'), 'a+b') as f:
+                f.seek(0)
+                bix = f.read()
+                end = 0
+                while end + self.BIX.size <= len(bix):
+                    if self.BIX.unpack_from(bix, end)[1] >= self.seg_blocks:
+                        break
+                    end += self.BIX.size
+                f.truncate(end)
+        else:
+            seg = self.segments[-1] + 1 if self.segments else 0
+            self.segments.append(seg)
+            self.seg_blocks = 0
 
-    return auth['session']
+        self.files = [open(self.segment_file(seg, ext), 'ab')
+                      for ext in ('log', 'bix', 'tix')]
+        # Append mode doesn't promise tell() is right until a write
+        self.files[0].seek(0, os.SEEK_END)
 
+    def flush(self):
+        if not self.pending:
+            return
+
+        if self.files is None or self.files[0].tell() >= self.SEGMENT_SIZE:
+            self.open_segment()
+        log, bix, tix = self.files
+
+        data = zlib.compress('\n'.join(self.pending) + '\n')
+        off = log.tell()
+        log.write(data)
+        log.flush()
+
+        block = len(self.blocks)
+        for bid, eid in self.pending_bids.iteritems():
+            bix.write(self.BIX.pack(bid, self.seg_blocks, eid))
+            self.bid_blocks[bid].append(block)
+        bix.flush()
+        tix.write(self.TIX.pack(off, len(data), self.pending_first,
+                                self.pending_last, self.pending_highlights))
+        tix.flush()
+
+        self.blocks.append((self.segments[-1], off, len(data),
+                            self.pending_first, self.pending_last,
+                            self.pending_highlights))
+        self.times.append(self.pending_last)
+        self.seg_blocks += 1
+
+        self.pending = []
+        self.pending_bids = {}
+        self.pending_highlights = 0
+
+    def tick(self):
+        self.flush()
+        self.loop.call_later(self.FLUSH_INTERVAL, self.tick)
+
+    def read_block(self, i):
+        seg, off, length = self.blocks[i][:3]
+        mm = self.maps.get(seg)
+        if mm is None or len(mm) < off + length:
+            # The segment has grown since it was mapped
+            with open(self.segment_file(seg, 'log'), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[seg] = mm
+        return zlib.decompress(mm[off:off + length]).split('\n')[:-1]
+
+    def tail(self, bid, n):
+        """Return the last n archived lines from a buffer, oldest first."""
+        lines = []
+        for i in reversed(self.bid_blocks.get(bid, ())):
+            found = []
+            for line in self.read_block(i):
+                m = BID_RE.search(line)
+                if m and int(m.group(1)) == bid:
+                    found.append(line)
+            lines[:0] = found
+            if len(lines) >= n:
+                break
+        return lines[-n:] if n > 0 else []
+
+    def highlights(self, since):
+        """Yield archived highlights timestamped at or after since."""
+        # Nothing can have happened after the block it arrived in
+        for i in xrange(bisect.bisect_left(self.times, since),
+                        len(self.blocks)):
+            if not self.blocks[i][5]:
+                continue
+            for line in self.read_block(i):
+                if HIGHLIGHT_RE.search(line):
+                    if simplejson.loads(line).get('time', 0) >= since:
+                        yield line
+
+    def restore(self, sh):
+        """Rebuild a StreamHandler's state from the archive."""
+        start = 0
+        checkpoints = self.bid_blocks.get(self.CHECKPOINT)
+        if checkpoints:
+            start = checkpoints[-1]
+            sh.restore(simplejson.loads(self.read_block(start)[0]))
+
+        blocks = self.bid_blocks.get(self.STATE, [])
+        for i in blocks[bisect.bisect_left(blocks, start):]:
+            for line in self.read_block(i):
+                m = TYPE_RE.search(line)
+                kind = m and m.group(1)
+                if kind in STATE_EVENTS and kind != 'backlog_complete':
+                    sh.dispatch(simplejson.loads(line))
+        sh.last_eid = self.last_eid
+        sh.dirty = False
 
-def get_stream(session, sh):
-    m = pycurl.CurlMulti()
 
-    c = pycurl.Curl()
-    c.setopt(pycurl.URL, 'https://irccloud.com/chat/stream')
+def get_stream(base_url, session, sh, cm, on_done, record=None, c=None):
+    """Follow the stream, optionally copying it raw to the file record."""
+    url = base_url + '/chat/stream'
+    if sh.last_eid:
+        url += '?' + urllib.urlencode([('since_id', sh.last_eid)])
+
+    if c is None:
+        c = pycurl.Curl()
+    c.setopt(pycurl.URL, url)
+    c.setopt(pycurl.HTTPGET, 1)
     c.setopt(pycurl.COOKIE, 'session=%s' % session)
-    c.setopt(pycurl.WRITEFUNCTION, sh.on_receive)
+    if record:
+        def write(data):
+            record.write(data)
+            sh.on_receive(data)
+        c.setopt(pycurl.WRITEFUNCTION, write)
+    else:
+        c.setopt(pycurl.WRITEFUNCTION, sh.on_receive)
 
-    # Store a reference to the Curl object on the CurlMulti object
-    # because pycurl is too dumb to
-    m.handles = [c]
-    for h in m.handles:
-        m.add_handle(h)
+    cm.add(c, on_done)
+    return c
 
-    return CurlManager(m)
 
+class RelayClient(object):
+    """One subscriber to a Relay.
+
+    A subscriber starts by sending a line of JSON with its filter,
+    which may restrict it to some event "types", "cids" or "bids"; an
+    empty object gets everything. It's then sent a snapshot of the
+    current server and buffer state, followed by every matching line
+    from the stream. The filter only applies to the stream; the
+    snapshot is always sent whole, so that subscribers know about
+    every server and see backlog_complete.
+    """
+
+    def __init__(self, relay, sock):
+        self.relay = relay
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.inbuf = ''
+        self.filter = None
+        self.outbuf = collections.deque()
+        self.queued = 0
+        self.events = READ
+        self.closed = False
+
+    def on_io(self, fd, events):
+        if events & (READ | ERROR):
+            try:
+                data = self.sock.recv(4096)
+            except socket.error:
+                data = ''
+            if not data:
+                self.close()
+                return
+            if self.filter is None and not self.closed:
+                self.inbuf += data
+                if '\n' in self.inbuf:
+                    self.subscribe(self.inbuf.split('\n', 1)[0])
+
+        if events & WRITE:
+            self.flush()
+
+    def subscribe(self, line):
+        try:
+            spec = simplejson.loads(line)
+            self.filter = dict((k, frozenset(spec[k]))
+                               for k in ('types', 'cids', 'bids')
+                               if k in spec)
+        except (ValueError, TypeError, AttributeError):
+            self.close()
+            return
+        self.inbuf = ''
+
+        for line, kind in self.relay.snapshot():
+            self.write(line)
+
+    def wants(self, line, kind):
+        f = self.filter
+        if 'types' in f and kind not in f['types']:
+            return False
+        for key, regex in (('cids', CID_RE), ('bids', BID_RE)):
+            if key in f:
+                m = regex.search(line)
+                if not m or int(m.group(1)) not in f[key]:
+                    return False
+        return True
+
+    def send(self, line, kind):
+        """Pass on a line from the stream, if it matches the filter."""
+        if self.filter is not None and self.wants(line, kind):
+            self.write(line)
+
+    def write(self, line):
+        if self.closed or self.filter is None:
+            return
+
+        if self.queued + len(line) > self.relay.max_queued:
+            # A subscriber that can't keep up is cut loose rather than
+            # being allowed to buffer without bound
+            self.close()
+            return
+
+        was_empty = not self.outbuf
+        self.outbuf.append(line + '\n')
+        self.queued += len(line) + 1
+        if was_empty:
+            self.flush()
+
+    def flush(self):
+        if self.closed:
+            return
+
+        while self.outbuf:
+            data = self.outbuf[0]
+            try:
+                sent = self.sock.send(data)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.close()
+                return
+            self.queued -= sent
+            if sent < len(data):
+                self.outbuf[0] = data[sent:]
+                break
+            self.outbuf.popleft()
+
+        events = READ
+        if self.outbuf:
+            events |= WRITE
+        if events != self.events:
+            self.events = events
+            self.relay.loop.watch(self.fd, events, self.on_io)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        del self.relay.clients[self.fd]
+        self.relay.loop.unwatch(self.fd)
+        self.sock.close()
+
+
+class Relay(object):
+    """Serve one account's stream to local subscribers on a unix socket.
+
+    Lines are passed on as they come off the upstream stream, so any
+    number of local clients can share one connection to irccloud.
+    Each subscriber has its own queue of at most `max_queued` bytes.
+
+    The backlog is not passed on, since subscribers that have already
+    seen backlog_complete would take a replay after an upstream
+    reconnect for new messages. Instead, when backlog_complete
+    arrives, every subscriber is sent a fresh snapshot.
+    """
+
+    def __init__(self, loop, path, sh, max_queued=1024 * 1024):
+        self.loop = loop
+        self.sh = sh
+        self.max_queued = max_queued
+        self.clients = {}
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0600)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        self.loop.watch(self.sock.fileno(), READ, self.on_accept)
+
+        sh.taps.append(self.publish)
+
+    def on_accept(self, fd, events):
+        try:
+            sock, _ = self.sock.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+
+        client = RelayClient(self, sock)
+        self.clients[client.fd] = client
+        self.loop.watch(client.fd, READ, client.on_io)
+
+    def snapshot(self):
+        """Yield (line, type) pairs that recreate the current state."""
+        for server in self.sh.servers.itervalues():
+            ev = server.to_dict()
+            ev['type'] = 'makeserver'
+            yield simplejson.dumps(ev), 'makeserver'
+        for buf in self.sh.buffers.itervalues():
+            ev = buf.to_dict()
+            ev['type'] = 'makebuffer'
+            yield simplejson.dumps(ev), 'makebuffer'
+        if self.sh.past_backlog:
+            yield '{"type":"backlog_complete"}', 'backlog_complete'
+
+    def publish(self, line, kind):
+        if not self.sh.past_backlog:
+            if kind == 'backlog_complete':
+                # Taps run before the line is dispatched, so the
+                # snapshot doesn't include backlog_complete yet
+                snap = list(self.snapshot()) + [(line, kind)]
+                for client in self.clients.values():
+                    for snap_line, _ in snap:
+                        client.write(snap_line)
+            return
+
+        for client in self.clients.values():
+            client.send(line, kind)
 
-def main():
-    global ICON_PIXBUF
 
-    pynotify.init('irccloud-osd')
-    ICON_PIXBUF = gtk.gdk.pixbuf_new_from_xpm_data(ICON)
+class RelaySource(object):
+    """Follow a stream served by another process's Relay."""
 
+    RETRY = 5
+
+    def __init__(self, loop, path, notifier, rules):
+        self.loop = loop
+        self.path = path
+        self.sh = StreamHandler(notifier, rules)
+        self.sock = None
+
+    def start(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            sock.sendall('{}\n')
+        except socket.error, e:
+            sock.close()
+            self.lost('Relay unavailable: %s' % e)
+            return
+        sock.setblocking(False)
+
+        self.sock = sock
+        self.sh.reset()
+        self.loop.watch(sock.fileno(), READ, self.on_io)
+
+    def on_io(self, fd, events):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+
+        if data:
+            self.sh.on_receive(data)
+            return
+
+        self.loop.unwatch(fd)
+        self.sock.close()
+        self.sock = None
+        self.sh.drain()
+        self.lost('Relay closed')
+
+    def lost(self, msg):
+        print >>sys.stderr, '%s: %s; reconnecting in %d seconds' % (
+            self.path, msg, self.RETRY)
+        self.loop.call_later(self.RETRY, self.start)
+
+    def save(self):
+        pass
+
+
+class Account(object):
+    """One irccloud account, streamed over a shared CurlManager.
+
+    The account logs in, follows its stream, and logs in and resumes
+    again with an increasing delay whenever the stream drops.
+    """
+
+    MIN_RETRY = 5
+    MAX_RETRY = 300
+
+    def __init__(self, email, password, cm, notifier, rules, opts, on_failed):
+        self.email = email
+        self.password = password
+        self.cm = cm
+        self.loop = cm.loop
+        self.on_failed = on_failed
+        self.sh = StreamHandler(notifier, rules, opts.backlog_workers)
+        self.retry = self.MIN_RETRY
+        self.base_url = opts.base_url
+
+        # Login and stream take turns on one handle, so the stream can
+        # go out on the connection the login left open
+        self.curl = cm.curl()
+        if opts.compression:
+            # libcurl inflates as it goes, so the framer still gets
+            # plain lines
+            self.curl.setopt(pycurl.ENCODING, 'gzip, deflate')
+
+        self.session_path = session_path(opts.state_dir, email)
+        self.session = None
+        if self.session_path:
+            self.session = load_session(self.session_path,
+                                        opts.session_max_age)
+        self.fresh = False
+        self.refused = False
+        self.sh.taps.append(self.check_refused)
+
+        self.record = None
+        if opts.record:
+            self.record = open(os.path.join(opts.record,
+                                            '%s.stream' % email), 'ab')
+
+        self.relay = None
+        if opts.relay:
+            self.relay = Relay(self.loop,
+                               os.path.join(opts.relay, '%s.sock' % email),
+                               self.sh, opts.relay_buffer)
+
+        self.archive = None
+        if opts.archive:
+            self.archive = Archive(os.path.join(opts.archive, email),
+                                   self.loop, self.sh)
+            self.sh.taps.append(self.archive.append)
+
+        self.saver = None
+        path = state_path(opts.state_dir, email)
+        snap = path and load_state(path, opts.state_max_age)
+        if snap:
+            self.sh.restore(snap)
+        elif (self.archive and
+              time.time() - self.archive.updated <= opts.state_max_age):
+            self.archive.restore(self.sh)
+        if path:
+            self.saver = StateSaver(self.loop, path, self.sh)
+
+    def log(self, msg):
+        print >>sys.stderr, '%s: %s' % (self.email, msg)
+
+    def start(self):
+        # Reconnects, and restarts with a cached session, skip logging in
+        if self.session:
+            self.stream()
+        else:
+            get_session(self.base_url, self.email, self.password, self.cm,
+                        self.login_done, self.curl)
+
+    def login_done(self, auth):
+        if auth is None:
+            self.log('Login failed')
+            self.reconnect()
+        elif not auth.get('success'):
+            self.log('Authentication failure')
+            self.on_failed(self)
+        else:
+            self.session = auth['session']
+            self.fresh = True
+            if self.session_path:
+                save_session(self.session_path, self.session)
+            self.stream()
+
+    def stream(self):
+        self.refused = False
+        self.sh.reset()
+        get_stream(self.base_url, self.session, self.sh, self.cm,
+                   self.stream_done, self.record, self.curl)
+
+    def check_refused(self, line, kind):
+        if kind is None and REFUSED_RE.search(line):
+            self.refused = True
+
+    def stream_done(self, c, err, errmsg):
+        self.sh.drain()
+        if self.refused or c.getinfo(pycurl.RESPONSE_CODE) in (401, 403):
+            self.session = None
+            if self.session_path:
+                forget_session(self.session_path)
+            # A session we had lying around has probably just expired,
+            # but one we were only just given deserves a pause
+            if not self.fresh:
+                self.log('Session expired; logging in again')
+                self.start()
+                return
+            self.log('Session refused')
+            self.reconnect()
+            return
+        self.fresh = False
+
+        if err is None:
+            self.log('Stream closed by server')
+        else:
+            self.log('Stream failed: %s' % errmsg)
+
+        # A stream that made it to live events was healthy, so don't
+        # hold its earlier failures against it
+        if self.sh.past_backlog:
+            self.retry = self.MIN_RETRY
+        self.reconnect()
+
+    def reconnect(self):
+        self.log('Reconnecting in %d seconds' % self.retry)
+        self.loop.call_later(self.retry, self.start)
+        self.retry = min(self.retry * 2, self.MAX_RETRY)
+
+    def save(self):
+        if self.saver:
+            self.saver.save()
+        if self.archive:
+            self.archive.flush()
+        if self.record:
+            self.record.flush()
+
+
+def query_archive(opts):
+    archive = Archive(os.path.join(opts.archive, opts.email))
+    if opts.archive_tail is not None:
+        lines = archive.tail(opts.archive_tail, opts.archive_lines)
+    else:
+        since = opts.archive_highlights
+        if since < 0:
+            since += time.time()
+        lines = archive.highlights(since)
+    for line in lines:
+        print line
+
+
+def main():
     opts = parse_options()
-    session = get_session(opts)
-    sh = StreamHandler()
-    cm = get_stream(session, sh)
+    if opts.query:
+        return query_archive(opts)
+
+    if opts.accounts:
+        try:
+            credentials = read_accounts(opts.accounts)
+        except (IOError, ValueError), e:
+            print >>sys.stderr, "Can't read accounts from %s: %s" % (
+                opts.accounts, e)
+            return 1
+    elif opts.relay_sources:
+        credentials = []
+    else:
+        credentials = [(opts.email, opts.password)]
+
+    rules = None
+    if opts.rules:
+        try:
+            rules = RuleEngine.load(opts.rules)
+        except (IOError, ValueError, re.error), e:
+            print >>sys.stderr, "Can't load rules from %s: %s" % (opts.rules, e)
+            return 1
+
+    if opts.metrics_port:
+        serve_metrics(opts.metrics_port)
+
+    loop = LOOPS[opts.loop]()
+
+    # SIGUSR1 dumps metrics, and SIGUSR2 starts and stops profiling.
+    # The handlers only note the signal, since it may have landed while
+    # the main thread holds METRICS.lock; the work is done on the loop.
+    profiler = Profiler()
+    actions = {signal.SIGUSR1: lambda: sys.stderr.write(METRICS.render()),
+               signal.SIGUSR2: profiler.toggle}
+    signalled = set()
+
+    def check_signals():
+        while signalled:
+            actions[signalled.pop()]()
+        loop.call_later(SIGNAL_INTERVAL, check_signals)
+
+    for signum in actions:
+        signal.signal(signum, lambda signum, frame: signalled.add(signum))
+    loop.call_later(SIGNAL_INTERVAL, check_signals)
+    cm = CurlManager(loop)
+    workers = []
+    for spec in opts.sinks:
+        workers.append(SinkWorker(make_sink(spec, opts.history), spec,
+                                  opts.queue_size, opts.queue_policy,
+                                  opts.history))
+    notifier = Notifier(loop, workers, opts.coalesce, opts.history,
+                        opts.rate_limit)
+
+    accounts = []
+    failed = set()
+
+    def account_failed(account):
+        failed.add(account)
+        if len(failed) == len(accounts):
+            loop.stop()
+
+    for email, password in credentials:
+        accounts.append(Account(email, password, cm, notifier, rules, opts,
+                                account_failed))
+    for path in opts.relay_sources or ():
+        accounts.append(RelaySource(loop, path, notifier, rules))
+
+    # All logins go out at once and complete in whatever order the
+    # server answers them. Sinks set themselves up in the meantime.
+    for account in accounts:
+        account.start()
+    for worker in workers:
+        worker.start()
+
+    try:
+        loop.run()
+    finally:
+        for account in accounts:
+            account.save()
+        for worker in workers:
+            worker.stop()
 
-    gtk.main()
+    if failed:
+        return 1
 
-ICON_PIXBUF = None
 ICON = [
 "129 129 73 1 ",
 "  c #527DFF",
@@ -0,0 +1,310 @@
+#!/usr/bin/python
+
+# Copyright (c) 2011 Evan Broder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# A stand-in for irccloud.com that serves /chat/login and /chat/stream
+# locally, either from a stream saved with irccloud-osd.py --record or
+# from synthetic traffic. Point irccloud-osd.py at it with --base-url.
+# GET /stats reports what it has served so far.
+
+import BaseHTTPServer
+import SocketServer
+import optparse
+import random
+import sys
+import threading
+import time
+import zlib
+
+import simplejson
+
+
+def synthetic_backlog(opts):
+    """Yield the lines of a made-up stream up to backlog_complete."""
+    rng = random.Random(opts.seed)
+    buffers = []
+    eid = 0
+
+    for cid in xrange(1, opts.servers + 1):
+        yield simplejson.dumps({
+                'bid': -1, 'eid': -1, 'type': 'makeserver', 'time': -1,
+                'highlight': False, 'cid': cid, 'name': 'Network%d' % cid,
+                'nick': 'replay', 'realname': 'Replay', 'hostname':
+                'irc.example.com', 'port': 6667, 'ssl': False})
+        for i in xrange(opts.buffers):
+            bid = cid * 100000 + i
+            # Live messages go to buffer 0, so make sure it notifies
+            if i == 0 or rng.random() < opts.conversations:
+                buffer_type, name = 'conversation', 'user%d' % i
+            else:
+                buffer_type, name = 'channel', '#channel%d' % i
+            buffers.append(bid)
+            yield simplejson.dumps({
+                    'bid': bid, 'eid': -1, 'type': 'makebuffer', 'time': -1,
+                    'highlight': False, 'name': name,
+                    'buffer_type': buffer_type, 'cid': cid, 'max_eid': 0,
+                    'focus': False, 'last_seen_eid': 0, 'joined': True,
+                    'hidden': False})
+
+    for i in xrange(opts.backlog):
+        eid += 1
+        bid = rng.choice(buffers)
+        yield simplejson.dumps({
+                'bid': bid, 'eid': eid, 'type': 'buffer_msg',
+                'time': int(time.time()), 'cid': bid // 100000,
+                'highlight': rng.random() < opts.highlights,
+                'from': 'someone', 'msg': 'backlog message %d' % i})
+
+    yield simplejson.dumps({'type': 'backlog_complete'})
+
+
+def synthetic_live(opts):
+    """Yield live message events.
+
+    They all go to a conversation buffer, so every one of them should
+    turn into a notification.
+    """
+    rng = random.Random(opts.seed + 1)
+    eid = opts.backlog
+    for i in xrange(opts.live):
+        eid += 1
+        cid = rng.randint(1, opts.servers)
+        yield {'bid': cid * 100000, 'eid': eid, 'type': 'buffer_msg',
+               'cid': cid, 'highlight': False, 'from': 'someone'}
+
+
+class StreamWriter(object):
+    """Write a response body, gzipped if the client asked for it.
+
+    Every write is sync-flushed, so the client can inflate each chunk
+    as it arrives, the same way it would with irccloud.com.
+    """
+
+    def __init__(self, handler, gzip):
+        self.handler = handler
+        self.zip = None
+        if gzip:
+            self.zip = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        if self.zip:
+            data = self.zip.compress(data) + self.zip.flush(zlib.Z_SYNC_FLUSH)
+        self.handler.server.count('wire_bytes', len(data))
+        self.handler.wfile.write(data)
+        self.handler.wfile.flush()
+
+    def close(self):
+        if self.zip:
+            data = self.zip.flush()
+            self.handler.server.count('wire_bytes', len(data))
+            self.handler.wfile.write(data)
+
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Logins leave the connection open for the stream to reuse; the
+    # stream itself ends by closing the connection
+    protocol_version = 'HTTP/1.1'
+
+    def send_body(self, body):
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.server.count('wire_bytes', len(body))
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.startswith('/chat/login'):
+            self.send_error(404)
+            return
+
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.count('logins')
+        self.send_response(200)
+        self.send_body(simplejson.dumps({'success': True,
+                                         'session': self.server.session}))
+
+    def do_GET(self):
+        if self.path.startswith('/stats'):
+            self.send_response(200)
+            self.send_body(simplejson.dumps(self.server.stats))
+            return
+        if not self.path.startswith('/chat/stream'):
+            self.send_error(404)
+            return
+
+        opts = self.server.opts
+        self.server.count('streams')
+        self.close_connection = True
+        gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Connection', 'close')
+        if gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        out = StreamWriter(self, gzip)
+
+        cookie = self.headers.get('Cookie', '')
+        if 'session=%s' % self.server.session not in cookie:
+            out.write(simplejson.dumps({'success': False,
+                                        'message': 'auth'}) + '\n')
+            out.close()
+            return
+
+        if opts.stream:
+            with open(opts.stream, 'rb') as f:
+                while True:
+                    data = f.read(opts.chunk_size)
+                    if not data:
+                        break
+                    out.write(data)
+            out.close()
+            return
+
+        backlog = self.server.backlog
+        for i in xrange(0, len(backlog), opts.chunk_size):
+            out.write(backlog[i:i + opts.chunk_size])
+
+        for i, ev in enumerate(synthetic_live(opts)):
+            if i % opts.burst == 0:
+                time.sleep(1.0 / opts.live_rate)
+            # Stamp the message with when it was sent, so the far end
+            # can work out how long it took to turn into a notification
+            ev['time'] = int(time.time())
+            ev['msg'] = 'live message @%f' % time.time()
+            out.write(simplejson.dumps(ev) + '\n')
+        out.close()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, opts):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', opts.port),
+                                           ReplayHandler)
+        self.opts = opts
+        self.session = opts.session
+        self.lock = threading.Lock()
+        self.stats = {'connections': 0, 'logins': 0, 'streams': 0,
+                      'wire_bytes': 0}
+
+        # Render the synthetic backlog up front, so that generating it
+        # doesn't limit how fast it can be served
+        self.backlog = None
+        if not opts.stream:
+            self.backlog = ''.join(line + '\n'
+                                   for line in synthetic_backlog(opts))
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+    def process_request(self, request, client_address):
+        self.count('connections')
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+
+def parse_options(args=None):
+    p = optparse.OptionParser()
+    p.add_option('--port',
+                 dest='port',
+                 type='int',
+                 default=0,
+                 help='Port to listen on (default: pick one and print it)')
+    p.add_option('--session',
+                 dest='session',
+                 default='replay',
+                 help='Session cookie to hand out, and the only one the '
+                 'stream accepts')
+    p.add_option('--stream',
+                 dest='stream',
+                 help='Serve this recorded stream instead of a synthetic one')
+    p.add_option('--chunk-size',
+                 dest='chunk_size',
+                 type='int',
+                 default=16384)
+    p.add_option('--servers',
+                 dest='servers',
+                 type='int',
+                 default=2)
+    p.add_option('--buffers',
+                 dest='buffers',
+                 type='int',
+                 default=20,
+                 help='Buffers per server')
+    p.add_option('--conversations',
+                 dest='conversations',
+                 type='float',
+                 default=0.25,
+                 help='Fraction of buffers that are conversations')
+    p.add_option('--backlog',
+                 dest='backlog',
+                 type='int',
+                 default=10000,
+                 help='Messages before backlog_complete')
+    p.add_option('--highlights',
+                 dest='highlights',
+                 type='float',
+                 default=0.01,
+                 help='Fraction of backlog messages that are highlights')
+    p.add_option('--live',
+                 dest='live',
+                 type='int',
+                 default=100,
+                 help='Messages after backlog_complete')
+    p.add_option('--live-rate',
+                 dest='live_rate',
+                 type='float',
+                 default=50,
+                 help='Live bursts per second')
+    p.add_option('--burst',
+                 dest='burst',
+                 type='int',
+                 default=1,
+                 help='Live messages sent back to back in each burst')
+    p.add_option('--seed',
+                 dest='seed',
+                 type='int',
+                 default=0)
+
+    opts, args = p.parse_args(args)
+    return opts
+
+
+def main():
+    opts = parse_options()
+    server = ReplayServer(opts)
+    print server.server_port
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,17 +6,21 @@ require 'rubygems'
 require 'json'
 require 'ruby-growl'
 require "getopt/long"
+require 'socket'
 
 opt = Getopt::Long.getopts(
       ["--email", "-e",     Getopt::REQUIRED],
-      ["--password", "-p",  Getopt::REQUIRED]
+      ["--password", "-p",  Getopt::REQUIRED],
+      ["--relay", "-r",     Getopt::REQUIRED]
       )
 
 email = opt['email'] 
 pass  = opt['password']
+relay = opt['relay']
 
-if !email or !pass then
+if !relay and (!email or !pass) then
     puts 'Usage: ' + $0 + ' --email <you@example.com> --password <your_password>'
+    puts '   or: ' + $0 + ' --relay <irccloud-osd.py relay socket>'
     puts ' '
     puts '..and make sure growl is set to allow network connections/registrations, no pass'
     exit
@@ -24,6 +28,58 @@ end
 
 growl = Growl.new("127.0.0.1", "ruby-growl", ["irccloud-ruby"])
 
+eob     = {}
+servers = {}
+buffers = {}
+
+handle_event = lambda do |ev, line|
+    case ev['type']
+    when 'makeserver'
+        servers[ev['cid']] = {  'hostname'  => ev['hostname'],
+                                'post'      => ev['port'],
+                                'name'      => ev['name'] }
+        puts 'Added server: ' + ev['name']
+
+    when 'channel_init', 'buffer_init'
+        name = ev['url'].split('/').last # hack :)
+        buffers[ev['bid']] = {  'url'   => ev['url'], 
+                                'cid'   => ev['cid'], 
+                                'name'  => name }
+        puts 'Added buffer: ' + ev['url'] + ' ' + ev['bid'].to_s
+
+    when 'makebuffer'
+        buffers[ev['bid']] = {  'cid'   => ev['cid'],
+                                'name'  => ev['name'] }
+        puts 'Added buffer: ' + ev['name'] + ' ' + ev['bid'].to_s
+
+    when 'end_of_backlog'
+        eob[ev['cid']] = true
+
+    when 'backlog_complete'
+        servers.each_key { |cid| eob[cid] = true }
+    
+    else
+        if eob[ev['cid']] == true and ev['highlight'] == true then
+            if buf = buffers[ev['bid']] then
+                ser = servers[buf['cid']]
+                title = buf['name'] + ' (' + ser['name'] + ')'
+                msg   = ev['msg'] 
+                growl.notify("irccloud-ruby", title, msg)
+            else
+                puts 'LINE, UNKNOWN BUFFER: '+line
+            end
+        end
+    end
+end
+
+# share the stream of an irccloud-osd.py --relay instead of logging in:
+if relay then
+    sock = UNIXSocket.new(relay)
+    sock.write("{}\n")
+    sock.each_line { |line| handle_event.call(JSON.parse(line), line) }
+    exit
+end
+
 uri_login  = URI.parse('https://irccloud.com/chat/login')
 uri_stream = URI.parse('https://irccloud.com/chat/stream')
 
@@ -42,9 +98,6 @@ else
     res.error!
 end
 
-eob     = {}
-servers = {}
-buffers = {}
 buffer  = ''
 # start stream
 http = Net::HTTP.new(uri_stream.host, uri_stream.port)
@@ -57,35 +110,7 @@ http.request_get(uri_stream.path, {'cookie'=>session}) {|response|
         lines.each { |line|
             begin
                 ev = JSON.parse line
-                case ev['type']
-                when 'makeserver'
-                    servers[ev['cid']] = {  'hostname'  => ev['hostname'],
-                                            'post'      => ev['port'],
-                                            'name'      => ev['name'] }
-                    puts 'Added server: ' + ev['name']
-                
-                when 'channel_init', 'buffer_init'
-                    name = ev['url'].split('/').last # hack :)
-                    buffers[ev['bid']] = {  'url'   => ev['url'], 
-                                            'cid'   => ev['cid'], 
-                                            'name'  => name }
-                    puts 'Added buffer: ' + ev['url'] + ' ' + ev['bid'].to_s
-
-                when 'end_of_backlog'
-                    eob[ev['cid']] = true
-                
-                else
-                    if eob[ev['cid']] == true and ev['highlight'] == true then
-                        if buf = buffers[ev['bid']] then
-                            ser = servers[buf['cid']]
-                            title = buf['name'] + ' (' + ser['name'] + ')'
-                            msg   = ev['msg'] 
-                            growl.notify("irccloud-ruby", title, msg)
-                        else
-                            puts 'LINE, UNKNOWN BUFFER: '+line
-                        end
-                    end
-                end
+                handle_event.call(ev, line)
             rescue JSON::JSONError => e
                 buffer = line
                 next